@@ -0,0 +1,93 @@
+"""
+Cached schema payloads: plain JSON (the previous format) vs `cache_codec`
+(columnar locations + interned strings, orjson + zstd).
+
+Builds a realistic final schema with `compute_frequencies_and_locations`, then
+reports encoded size and encode/decode time. If Redis is reachable at
+REDIS_URL, it also reports `MEMORY USAGE` for both values.
+
+Run from the backend directory:
+    python benchmarks/bench_cache_codec.py
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis  # noqa: E402
+
+import cache_codec  # noqa: E402
+from schemaAgent import INITIAL_STATS, compute_frequencies_and_locations  # noqa: E402
+
+FIRST = ["Ramesh", "Suresh", "Lakshmi", "Priya", "Kiran", "Anil", "Divya", "Ravi"]
+LAST = ["Kumar", "Sharma", "Iyer", "Reddy", "Nair", "Menon", "Rao", "Das"]
+
+
+def make_state(rng: random.Random, n_docs: int, n_fields: int):
+    fields = {}
+    for i in range(n_fields):
+        refs = [f"{rng.choice(FIRST)} {rng.choice(LAST)} {i}", f"REF-{i:04d}/2024"]
+        fields[f"field_{i}"] = {"label": f"Field {i}", "references": refs, "source_files": []}
+
+    all_refs = [ref for field in fields.values() for ref in field["references"]]
+    documents = []
+    for d in range(n_docs):
+        lines = []
+        for line_no in range(400):
+            prefix = rng.choice(["", "# ", "| ", "- "])
+            picked = " and ".join(rng.sample(all_refs, 2))
+            lines.append(f"{prefix}Line {line_no}: this certifies that {picked} attended the event.")
+        documents.append((f"Event_Certificate_{d:02d}.docx", "\n".join(lines)))
+
+    return {
+        "documents": documents,
+        "final_schema": {"document_fields": {"fields": fields}},
+        "stats": dict(INITIAL_STATS),
+    }
+
+
+def timed(fn, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    state = make_state(random.Random(3), n_docs=12, n_fields=120)
+    update = compute_frequencies_and_locations(state)
+    payload = {"schema": update["final_schema"], "stats": update["stats"]}
+    print(f"\nPayload: {update['stats']['total_locations']} locations across 120 fields")
+
+    repeat = 5
+    json_bytes, json_encode_ms = timed(lambda: json.dumps(payload).encode(), repeat)
+    _, json_decode_ms = timed(lambda: json.loads(json_bytes), repeat)
+    codec_bytes, codec_encode_ms = timed(lambda: cache_codec.encode(payload), repeat)
+    decoded, codec_decode_ms = timed(lambda: cache_codec.decode(codec_bytes), repeat)
+    assert decoded == json.loads(json_bytes), "codec round-trip mismatch"
+
+    print(f"{'':14}{'bytes':>12}{'encode ms':>12}{'decode ms':>12}")
+    print(f"{'json':14}{len(json_bytes):>12,}{json_encode_ms:>12.1f}{json_decode_ms:>12.1f}")
+    print(f"{'cache_codec':14}{len(codec_bytes):>12,}{codec_encode_ms:>12.1f}{codec_decode_ms:>12.1f}")
+    print(f"size ratio: {len(json_bytes) / len(codec_bytes):.1f}x smaller")
+
+    try:
+        client = redis.Redis.from_url(
+            os.getenv("REDIS_URL", "redis://localhost:6379/0"), socket_connect_timeout=0.5
+        )
+        client.set("bench:json", json_bytes, ex=60)
+        client.set("bench:codec", codec_bytes, ex=60)
+        print(
+            f"Redis MEMORY USAGE: json={client.memory_usage('bench:json'):,} B, "
+            f"codec={client.memory_usage('bench:codec'):,} B"
+        )
+        client.delete("bench:json", "bench:codec")
+    except redis.RedisError as e:
+        print(f"Redis not reachable ({e}); MEMORY USAGE ≈ value bytes above plus ~100 B/key")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark: one paragraph walk per replacement pair vs the single-pass
+ParagraphTextIndex used by `replace_text_in_document_bytes`.
+
+Run from the backend directory:
+    python benchmarks/bench_docx_replace.py
+"""
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document  # noqa: E402
+
+from replace import (  # noqa: E402
+    _iter_textbox_paragraphs,
+    _replace_across_runs_preserve_style,
+    apply_replacements_to_document,
+)
+
+WORDS = (
+    "the department of computer science organises a guest lecture on "
+    "enterprise applications for students faculty and research scholars"
+).split()
+
+
+def make_document(rng: random.Random, references, n_paragraphs: int) -> bytes:
+    doc = Document()
+    for _ in range(n_paragraphs):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 30))]
+        if rng.random() < 0.2:
+            words.insert(rng.randint(0, len(words)), rng.choice(references))
+        text = " ".join(words)
+        para = doc.add_paragraph()
+        # a few runs per paragraph, so matches cross run boundaries
+        cuts = sorted(rng.sample(range(1, len(text)), 3)) + [len(text)]
+        prev = 0
+        for i, cut in enumerate(cuts):
+            para.add_run(text[prev:cut]).bold = i % 2 == 0
+            prev = cut
+    stream = BytesIO()
+    doc.save(stream)
+    return stream.getvalue()
+
+
+def replace_per_pair(doc, replacements) -> int:
+    """The previous approach: every pair walks every paragraph and text box."""
+    total = 0
+    for old_value, new_value in replacements:
+        for para in doc.paragraphs:
+            total += _replace_across_runs_preserve_style(para, old_value, new_value)
+        for para in _iter_textbox_paragraphs(doc):
+            total += _replace_across_runs_preserve_style(para, old_value, new_value)
+    return total
+
+
+def run(n_pairs: int, n_paragraphs: int) -> None:
+    rng = random.Random(42)
+    references = [f"Reference {i} {rng.choice(WORDS).title()}" for i in range(n_pairs)]
+    # new values never contain an old value, so both approaches agree
+    replacements = [(ref, f"VALUE-{i}") for i, ref in enumerate(references)]
+    data = make_document(rng, references, n_paragraphs)
+
+    baseline_doc = Document(BytesIO(data))
+    start = time.perf_counter()
+    baseline_count = replace_per_pair(baseline_doc, replacements)
+    baseline_time = time.perf_counter() - start
+
+    single_doc = Document(BytesIO(data))
+    start = time.perf_counter()
+    single_count = apply_replacements_to_document(single_doc, replacements)
+    single_pass_time = time.perf_counter() - start
+
+    assert baseline_count == single_count, (baseline_count, single_count)
+    assert [p.text for p in baseline_doc.paragraphs] == [p.text for p in single_doc.paragraphs]
+    print(
+        f"pairs={n_pairs:>3} paragraphs={n_paragraphs:>5} replaced={single_count:>5} "
+        f"| per-pair {baseline_time * 1000:9.1f} ms "
+        f"| single-pass {single_pass_time * 1000:8.1f} ms "
+        f"| x{baseline_time / max(single_pass_time, 1e-9):.1f}"
+    )
+
+
+if __name__ == "__main__":
+    run(n_pairs=5, n_paragraphs=200)
+    run(n_pairs=40, n_paragraphs=600)
+    run(n_pairs=40, n_paragraphs=2000)
@@ -0,0 +1,87 @@
+"""
+Benchmark: per-reference markdown location search vs the single-pass
+multi-pattern locator used by `compute_frequencies_and_locations`.
+
+Run from the backend directory:
+    python benchmarks/bench_reference_locator.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from schemaAgent import (  # noqa: E402
+    build_reference_matcher,
+    find_reference_locations_in_markdown,
+    locate_references_in_markdown,
+)
+
+WORDS = (
+    "the department of computer science organises a guest lecture on "
+    "enterprise applications for students faculty and research scholars"
+).split()
+
+
+def make_document(rng: random.Random, references, n_lines: int) -> str:
+    lines = []
+    for i in range(n_lines):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+        if rng.random() < 0.15:
+            words.insert(rng.randint(0, len(words)), rng.choice(references))
+        line = " ".join(words)
+        if i % 25 == 0:
+            line = "## " + line
+        elif i % 7 == 0:
+            line = "- " + line
+        elif i % 11 == 0:
+            line = "| " + line + " |"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def run(n_docs: int, n_fields: int, refs_per_field: int, n_lines: int) -> None:
+    rng = random.Random(42)
+    references = [
+        f"Reference {f}-{r} {rng.choice(WORDS).title()}"
+        for f in range(n_fields)
+        for r in range(refs_per_field)
+    ]
+    documents = [
+        (f"doc_{i}.docx", make_document(rng, references, n_lines)) for i in range(n_docs)
+    ]
+
+    start = time.perf_counter()
+    baseline = {}
+    for ref in references:
+        for filename, markdown in documents:
+            baseline[(ref, filename)] = find_reference_locations_in_markdown(
+                markdown, ref, filename
+            )
+    baseline_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = build_reference_matcher(references)
+    located = {
+        filename: locate_references_in_markdown(markdown, matcher, filename)
+        for filename, markdown in documents
+    }
+    single_pass_time = time.perf_counter() - start
+
+    for (ref, filename), expected in baseline.items():
+        assert located[filename].get(ref, []) == expected, (ref, filename)
+
+    total = sum(len(v) for v in baseline.values())
+    print(
+        f"docs={n_docs:>3} refs={len(references):>4} lines/doc={n_lines:>5} "
+        f"locations={total:>6} | per-reference {baseline_time * 1000:9.1f} ms "
+        f"| single-pass {single_pass_time * 1000:8.1f} ms "
+        f"| x{baseline_time / max(single_pass_time, 1e-9):.1f}"
+    )
+
+
+if __name__ == "__main__":
+    run(n_docs=5, n_fields=10, refs_per_field=2, n_lines=200)
+    run(n_docs=20, n_fields=40, refs_per_field=3, n_lines=400)
+    run(n_docs=20, n_fields=40, refs_per_field=3, n_lines=2000)
@@ -0,0 +1,83 @@
+"""
+Token counting: exact tiktoken counts vs the character-class estimator
+(`TOKEN_COUNT_MODE=estimate`), plus the cost of importing schemaAgent and of
+the first (lazy) encoder load.
+
+Run from the backend directory:
+    python benchmarks/bench_token_estimate.py
+"""
+import os
+import random
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+SNIPPETS = [
+    "MEMORANDUM OF UNDERSTANDING between the University of Mumbai and Tata Consultancy Services Limited.",
+    "| Name | Designation | Date | Amount |\n|---|---|---|---|\n| Dr. John Smith | Professor | 12/03/2024 | ₹1,25,000.00 |",
+    "**Venue:** Grand Hall, 221B Baker Street, London NW1 6XE. Contact: john.smith@example.com, +44 20 7946 0958",
+    "The Department of Computer Science & Engineering organised a two-day workshop on “Machine Learning” "
+    "on 14–15 March 2024. Participants from Société Générale attended.",
+    "1. Objectives\n   - To foster collaboration in research and development.\n   - To organise joint seminars.",
+    "Ref. No.: ABC/2024/REG/0457    Date: 03 April 2024\n\nSubject: Sanction of funds for the National "
+    "Conference on Renewable Energy (NCRE-2024)",
+]
+
+
+def make_documents(rng: random.Random, n: int):
+    return ["\n\n".join(rng.choice(SNIPPETS) for _ in range(rng.randint(5, 60))) for _ in range(n)]
+
+
+def timed_import(mode: str) -> float:
+    code = (
+        "import time; t = time.perf_counter(); import schemaAgent; "
+        "print(time.perf_counter() - t)"
+    )
+    env = dict(os.environ, TOKEN_COUNT_MODE=mode)
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    for mode in ("exact", "estimate"):
+        print(f"import schemaAgent (TOKEN_COUNT_MODE={mode}): {timed_import(mode):.2f}s")
+
+    import schemaAgent  # noqa: E402
+
+    start = time.perf_counter()
+    schemaAgent.get_encoding()
+    print(f"first encoder load (lazy):               {time.perf_counter() - start:.2f}s")
+
+    docs = make_documents(random.Random(7), 200)
+    encoding = schemaAgent.get_encoding()
+
+    start = time.perf_counter()
+    exact = [len(tokens) for tokens in encoding.encode_batch(docs)]
+    exact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    estimated = [schemaAgent.estimate_token_count(doc) for doc in docs]
+    estimate_time = time.perf_counter() - start
+
+    naive = [len(doc) // 4 + 1 for doc in docs]
+
+    def error(values):
+        errs = sorted(abs(v - e) / e for v, e in zip(values, exact))
+        return sum(errs) / len(errs), errs[int(len(errs) * 0.95)]
+
+    mean_est, p95_est = error(estimated)
+    mean_naive, p95_naive = error(naive)
+    print(f"\n{len(docs)} documents, {sum(exact)} tokens")
+    print(f"  tiktoken encode_batch: {exact_time * 1000:7.1f} ms")
+    print(f"  estimate_token_count:  {estimate_time * 1000:7.1f} ms")
+    print(f"  estimator error: mean {mean_est:.1%}, p95 {p95_est:.1%}")
+    print(f"  len/4 error:     mean {mean_naive:.1%}, p95 {p95_naive:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,13 @@
 BYOK Key Broker Service
 Handles secure key retrieval and LLM instantiation
 """
-from typing import Optional, Any
+from typing import Optional, Any, Callable, List
 from datetime import datetime
+from functools import partial
 from storage_service import get_user_supabase_client
 from byok_encryption import byok_crypto
 from byok_providers import get_provider_adapter
+from hedged_llm import HEDGING_ENABLED, HEDGE_FALLBACK_MODELS, HEDGE_MAX_FALLBACKS, LLMCandidate, hedge_llm
 import os
 
 class BYOKKeyBroker:
@@ -42,13 +44,7 @@ class BYOKKeyBroker:
                 encrypted_key = result.data['encrypted_key']
                 decrypted_key = byok_crypto.decrypt_api_key(encrypted_key)
                 
-                # Update last_used_at
-                supabase.table('llm_api_keys').update({
-                    'last_used_at': datetime.utcnow().isoformat()
-                }).eq('user_id', user_id).eq('provider', provider).execute()
-                
-                # Log usage
-                self._log_audit(supabase, user_id, provider, 'used', {'model': model})
+                self._mark_key_used(supabase, user_id, provider, {'model': model})
                 
                 # Create LLM with user's key
                 adapter = get_provider_adapter(provider)
@@ -73,6 +69,79 @@ class BYOKKeyBroker:
         # We no longer fallback to .env keys. Enforce BYOK only.
         raise ValueError(f"BYOK_SETUP_REQUIRED: No API keys available for provider '{provider}'. Please add your API key in Settings to continue.")
     
+    def get_fallback_llms(
+        self,
+        user_id: str,
+        exclude_provider: str,
+        jwt_token: Optional[str] = None,
+        **options
+    ) -> List[LLMCandidate]:
+        """
+        LLMs for the user's other active provider keys, one per provider and
+        at most HEDGE_MAX_FALLBACKS (hedging / failover candidates). A key is
+        audited as used only when a race starts its candidate. Never raises:
+        no keys, no fallbacks.
+        """
+        try:
+            supabase = get_user_supabase_client(jwt_token)
+            result = supabase.table('llm_api_keys').select('*').eq(
+                'user_id', user_id
+            ).eq('status', 'active').execute()
+        except Exception as e:
+            print(f"Failed to load fallback keys: {e}")
+            return []
+
+        candidates = []
+        for row in result.data or []:
+            if len(candidates) >= HEDGE_MAX_FALLBACKS:
+                break
+            provider = row.get('provider')
+            if provider == exclude_provider or any(c.provider == provider for c in candidates):
+                continue
+            model = row.get('model') or HEDGE_FALLBACK_MODELS.get(provider)
+            try:
+                adapter = get_provider_adapter(provider)
+                llm = adapter.create_llm(byok_crypto.decrypt_api_key(row['encrypted_key']), model, **options)
+            except Exception as e:
+                print(f"Failed to create fallback LLM for {provider}: {e}")
+                continue
+            mark_used = partial(
+                self._mark_key_used, supabase, user_id, provider, {'model': model, 'role': 'hedge_fallback'}
+            )
+            candidates.append(LLMCandidate(provider, model, llm, on_start=mark_used))
+        return candidates
+
+    def with_hedging(
+        self,
+        llm: Any,
+        user_id: Optional[str],
+        provider: str,
+        model: Optional[str],
+        jwt_token: Optional[str] = None,
+        on_abandoned: Optional[Callable[[LLMCandidate, Any, float], None]] = None,
+        **options
+    ) -> Any:
+        """
+        `llm` raced against the user's other providers (see hedged_llm) when
+        LLM_HEDGING_ENABLED is set; otherwise `llm` itself. Only for
+        idempotent extraction calls. `on_abandoned` gets losing calls that
+        still finished (e.g. llm_ledger.abandoned_call_recorder).
+        """
+        if not HEDGING_ENABLED or not user_id:
+            return llm
+        fallbacks = self.get_fallback_llms(user_id, provider, jwt_token, **options)
+        return hedge_llm(LLMCandidate(provider, model, llm), fallbacks, on_abandoned)
+
+    def _mark_key_used(self, supabase, user_id: str, provider: str, metadata: dict = None):
+        """Update the key's last_used_at and write a 'used' audit event"""
+        try:
+            supabase.table('llm_api_keys').update({
+                'last_used_at': datetime.utcnow().isoformat()
+            }).eq('user_id', user_id).eq('provider', provider).execute()
+        except Exception as e:
+            print(f"Failed to update last_used_at: {e}")
+        self._log_audit(supabase, user_id, provider, 'used', metadata)
+
     def _log_audit(self, supabase, user_id: str, provider: str, action: str, metadata: dict = None):
         """Log audit event"""
         try:
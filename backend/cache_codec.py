@@ -0,0 +1,154 @@
+"""
+Compact encoding for cached schema payloads.
+
+    encode(value) -> b"SC1" + zstd(orjson(envelope))
+
+Before serializing, every `locations` list of dicts is rewritten into a
+columnar block, and the string columns (filename, type, text, context_line,
+...) become indices into one string table shared by the whole payload. The
+same filename or reference text is then stored once instead of once per
+location.
+
+decode() also accepts plain JSON, so entries written before the codec existed
+stay readable until they expire.
+"""
+import json
+import threading
+from typing import Any, Dict, List, Tuple
+
+import orjson
+import zstandard
+
+MAGIC = b"SC1"
+ZSTD_LEVEL = 3
+COLUMNAR_KEY = "__columnar__"
+
+_local = threading.local()
+
+
+def _compressor() -> zstandard.ZstdCompressor:
+    # zstd (de)compressor objects must not be shared across threads
+    compressor = getattr(_local, "compressor", None)
+    if compressor is None:
+        compressor = _local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return compressor
+
+
+def _decompressor() -> zstandard.ZstdDecompressor:
+    decompressor = getattr(_local, "decompressor", None)
+    if decompressor is None:
+        decompressor = _local.decompressor = zstandard.ZstdDecompressor()
+    return decompressor
+
+
+class _StringTable:
+    def __init__(self):
+        self.strings: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def intern(self, value: str) -> int:
+        idx = self._index.get(value)
+        if idx is None:
+            idx = self._index[value] = len(self.strings)
+            self.strings.append(value)
+        return idx
+
+
+def _is_record_list(value: Any) -> bool:
+    return isinstance(value, list) and bool(value) and all(isinstance(item, dict) for item in value)
+
+
+def _to_columns(records: List[Dict[str, Any]], table: _StringTable) -> Dict[str, Any]:
+    """
+    Rows are grouped by key layout (markdown and DOCX locations differ);
+    `layout_of_row` keeps the original row order.
+    """
+    layouts: List[Tuple[str, ...]] = []
+    layout_ids: Dict[Tuple[str, ...], int] = {}
+    layout_rows: List[List[Dict[str, Any]]] = []
+    layout_of_row: List[int] = []
+    for record in records:
+        keys = tuple(record.keys())
+        layout_id = layout_ids.get(keys)
+        if layout_id is None:
+            layout_id = layout_ids[keys] = len(layouts)
+            layouts.append(keys)
+            layout_rows.append([])
+        layout_rows[layout_id].append(record)
+        layout_of_row.append(layout_id)
+
+    blocks = []
+    for keys, rows in zip(layouts, layout_rows):
+        columns = {}
+        for key in keys:
+            values = [row[key] for row in rows]
+            if all(type(v) is str for v in values):
+                columns[key] = {"s": [table.intern(v) for v in values]}
+            elif all(type(v) in (int, float, bool) or v is None for v in values):
+                columns[key] = {"n": values}
+            else:
+                columns[key] = {"v": [_pack(v, table) for v in values]}
+        blocks.append({"keys": list(keys), "columns": columns})
+
+    return {COLUMNAR_KEY: 1, "layout_of_row": layout_of_row, "blocks": blocks}
+
+
+def _from_columns(block: Dict[str, Any], strings: List[str]) -> List[Dict[str, Any]]:
+    lookup = strings.__getitem__
+    decoded_blocks = []
+    for layout in block["blocks"]:
+        keys = layout["keys"]
+        columns = []
+        for key in keys:
+            column = layout["columns"][key]
+            if "s" in column:
+                columns.append(map(lookup, column["s"]))
+            elif "n" in column:
+                columns.append(column["n"])
+            else:
+                columns.append([_unpack(v, strings) for v in column["v"]])
+        decoded_blocks.append([dict(zip(keys, row)) for row in zip(*columns)])
+    if len(decoded_blocks) == 1:
+        return decoded_blocks[0]
+    cursors = [iter(rows) for rows in decoded_blocks]
+    return [next(cursors[layout_id]) for layout_id in block["layout_of_row"]]
+
+
+def _pack(value: Any, table: _StringTable) -> Any:
+    if isinstance(value, dict):
+        packed = {}
+        for key, item in value.items():
+            if key == "locations" and _is_record_list(item):
+                packed[key] = _to_columns(item, table)
+            else:
+                packed[key] = _pack(item, table)
+        return packed
+    if isinstance(value, list):
+        return [_pack(item, table) for item in value]
+    return value
+
+
+def _unpack(value: Any, strings: List[str]) -> Any:
+    if isinstance(value, dict):
+        if value.get(COLUMNAR_KEY) == 1:
+            return _from_columns(value, strings)
+        return {key: _unpack(item, strings) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_unpack(item, strings) for item in value]
+    return value
+
+
+def encode(value: Any) -> bytes:
+    table = _StringTable()
+    data = _pack(value, table)
+    envelope = orjson.dumps({"strings": table.strings, "data": data}, option=orjson.OPT_NON_STR_KEYS)
+    return MAGIC + _compressor().compress(envelope)
+
+
+def decode(payload: Any) -> Any:
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if not payload.startswith(MAGIC):
+        return json.loads(payload)
+    envelope = orjson.loads(_decompressor().decompress(payload[len(MAGIC):]))
+    return _unpack(envelope["data"], envelope["strings"])
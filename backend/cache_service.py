@@ -0,0 +1,251 @@
+"""
+Schema Cache Service
+Two tiers behind one get/set API:
+  - Redis (REDIS_URL), pooled, with socket timeouts, connected lazily and guarded
+    by a circuit breaker so an absent or flapping Redis never stalls requests
+  - an in-process LRU bounded by entry count and bytes, honouring TTLs, used
+    whenever Redis is unavailable
+
+Values are stored encoded by `cache_codec` (columnar locations, orjson + zstd)
+in both tiers, so callers always get a private copy and the byte bound is exact.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+import cache_codec
+
+# Empty REDIS_URL disables the Redis tier
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "1.0"))
+REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", "3"))
+REDIS_BREAKER_COOLDOWN = float(os.getenv("REDIS_BREAKER_COOLDOWN", "30"))
+
+MEMORY_CACHE_MAX_ENTRIES = int(os.getenv("MEMORY_CACHE_MAX_ENTRIES", "1024"))
+MEMORY_CACHE_MAX_BYTES = int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class LRUTTLCache:
+    """
+    Thread-safe LRU over serialized values. Evicts least-recently-used entries
+    past `max_entries` or `max_bytes`; expired entries are dropped on access.
+    """
+
+    def __init__(self, max_entries: int = MEMORY_CACHE_MAX_ENTRIES, max_bytes: int = MEMORY_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def set(self, key: str, data: bytes, ttl: float) -> None:
+        if len(data) > self.max_bytes or ttl <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, data)
+            self._bytes += len(data)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key: str) -> None:
+        _, data = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+
+class RedisCircuit:
+    """
+    Lazily-created pooled Redis client behind a circuit breaker: after
+    `failure_threshold` consecutive errors the circuit opens and Redis is not
+    touched for `cooldown` seconds; the next call then probes it again.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = REDIS_URL,
+        max_connections: int = REDIS_MAX_CONNECTIONS,
+        connect_timeout: float = REDIS_CONNECT_TIMEOUT,
+        socket_timeout: float = REDIS_SOCKET_TIMEOUT,
+        failure_threshold: int = REDIS_BREAKER_FAILURES,
+        cooldown: float = REDIS_BREAKER_COOLDOWN,
+    ):
+        self.url = url
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.socket_timeout = socket_timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._client: Optional[redis.Redis] = None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._announced = False
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url)
+
+    @property
+    def state(self) -> str:
+        if not self.enabled:
+            return "disabled"
+        if self._opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self._opened_at < self.cooldown else "half-open"
+
+    def _get_client(self) -> redis.Redis:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    pool = redis.ConnectionPool.from_url(
+                        self.url,
+                        max_connections=self.max_connections,
+                        socket_connect_timeout=self.connect_timeout,
+                        socket_timeout=self.socket_timeout,
+                        # fail fast; the breaker decides when to try again
+                        retry=Retry(NoBackoff(), 0),
+                        health_check_interval=30,
+                    )
+                    self._client = redis.Redis(connection_pool=pool)
+        return self._client
+
+    def call(self, fn: Callable[[redis.Redis], Any]) -> Tuple[bool, Any]:
+        """(ok, result). ok=False when the circuit is open/disabled or the call failed."""
+        if self.state in ("disabled", "open"):
+            return False, None
+        try:
+            result = fn(self._get_client())
+        except Exception as e:
+            self._record_failure(e)
+            return False, None
+        self._record_success()
+        return True, result
+
+    def _record_success(self) -> None:
+        if self._opened_at is not None or not self._announced:
+            print("✅ Redis cache enabled")
+            self._announced = True
+        self._failures = 0
+        self._opened_at = None
+
+    def _record_failure(self, error: Exception) -> None:
+        self.errors += 1
+        self._failures += 1
+        if self._opened_at is not None or self._failures >= self.failure_threshold:
+            if self._opened_at is None:
+                print(f"⚠️ Redis unavailable ({error}); using in-memory cache")
+            self._opened_at = time.monotonic()
+
+
+class SchemaCache:
+    """Redis when reachable, otherwise the bounded in-process LRU."""
+
+    def __init__(
+        self,
+        redis_circuit: Optional[RedisCircuit] = None,
+        memory: Optional[LRUTTLCache] = None,
+        dumps: Callable[[Any], bytes] = cache_codec.encode,
+        loads: Callable[[bytes], Any] = cache_codec.decode,
+    ):
+        self.redis = redis_circuit if redis_circuit is not None else RedisCircuit()
+        self.memory = memory if memory is not None else LRUTTLCache()
+        self.dumps = dumps
+        self.loads = loads
+        self.counters = {"hits": 0, "misses": 0, "sets": 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        ok, data = self.redis.call(lambda client: client.get(key))
+        if not ok:
+            data = self.memory.get(key)
+        if data is None:
+            self.counters["misses"] += 1
+            return None
+        try:
+            value = self.loads(data)
+        except Exception:
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: int) -> None:
+        data = self.dumps(value)
+        self.counters["sets"] += 1
+        ok, _ = self.redis.call(lambda client: client.set(key, data, ex=ttl))
+        if not ok:
+            self.memory.set(key, data, ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": round(self.counters["hits"] / lookups, 3) if lookups else None,
+            "backend": "redis" if self.redis.state == "closed" else "memory",
+            "redis": {"state": self.redis.state, "errors": self.redis.errors},
+            "memory": {
+                "entries": len(self.memory),
+                "bytes": self.memory.size_bytes,
+                "max_entries": self.memory.max_entries,
+                "max_bytes": self.memory.max_bytes,
+                "evictions": self.memory.evictions,
+                "expirations": self.memory.expirations,
+            },
+        }
+
+
+schema_cache = SchemaCache()
+
+
+if __name__ == "__main__":
+    demo = SchemaCache(RedisCircuit(url=None), LRUTTLCache(max_entries=3, max_bytes=10_000))
+    for i in range(5):
+        demo.set(f"schema:{i}", {"fields": list(range(i))}, ttl=60)
+    demo.set("schema:short", {"fields": []}, ttl=0.05)
+    time.sleep(0.1)
+    print([demo.get(f"schema:{i}") for i in range(5)], demo.get("schema:short"))
+    print(json.dumps(demo.stats(), indent=2))
@@ -316,8 +316,11 @@ async def stream_agent_response(
     agent: Any,
     user_message: str,
     thread_id: str,
+    callbacks: Optional[list] = None,
 ):
     config = {"configurable": {"thread_id": thread_id}}
+    if callbacks:
+        config["callbacks"] = callbacks
     payload = {"messages": [{"role": "user", "content": user_message}]}
     last_reasoning_text = ""
 
@@ -0,0 +1,167 @@
+"""
+Discovery Checkpoints
+Durable state for resumable schema discovery runs, kept in one local SQLite
+file (SCHEMA_CHECKPOINT_DB):
+  - the LangGraph checkpointer (SqliteSaver): the graph state after every
+    node, keyed by run id (the LangGraph thread_id)
+  - document_partials: each document's partial schema as soon as it is
+    mapped, so a run that dies inside map_discover_schema resumes without
+    paying again for the documents that already finished
+  - discovery_runs: when each run was last started or resumed; runs idle for
+    SCHEMA_CHECKPOINT_TTL_SECONDS are deleted (checkpoints and partials)
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+import cache_codec
+
+SCHEMA_CHECKPOINT_DB = os.getenv(
+    "SCHEMA_CHECKPOINT_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema_checkpoints.sqlite"),
+)
+# Runs not started or resumed for this long are deleted
+SCHEMA_CHECKPOINT_TTL = int(os.getenv("SCHEMA_CHECKPOINT_TTL_SECONDS", str(7 * 24 * 3600)))
+# Expired runs are looked for at most this often
+CHECKPOINT_PRUNE_INTERVAL = 3600
+
+_lock = threading.Lock()
+_checkpointer: Optional[SqliteSaver] = None
+_last_prune = 0.0
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+    # WAL lets the checkpointer and the partial store write from separate connections
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def get_checkpointer() -> SqliteSaver:
+    global _checkpointer
+    if _checkpointer is None:
+        with _lock:
+            if _checkpointer is None:
+                _checkpointer = SqliteSaver(_connect(SCHEMA_CHECKPOINT_DB))
+                print(f"💾 Schema discovery checkpoints: {SCHEMA_CHECKPOINT_DB}")
+    return _checkpointer
+
+
+class DocumentPartialStore:
+    """Per-run, per-document partial schemas (encoded with cache_codec)."""
+
+    def __init__(self, path: str = SCHEMA_CHECKPOINT_DB):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = _connect(self.path)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS document_partials (
+                    run_id TEXT NOT NULL,
+                    doc_key TEXT NOT NULL,
+                    partial BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (run_id, doc_key)
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS discovery_runs (
+                    run_id TEXT PRIMARY KEY,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, run_id: str, doc_key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT partial FROM document_partials WHERE run_id = ? AND doc_key = ?",
+                (run_id, doc_key),
+            ).fetchone()
+        return cache_codec.decode(row[0]) if row else None
+
+    def put(self, run_id: str, doc_key: str, partial_schema: Dict[str, Any]) -> None:
+        data = cache_codec.encode(partial_schema)
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO document_partials (run_id, doc_key, partial, created_at) VALUES (?, ?, ?, ?)",
+                (run_id, doc_key, data, time.time()),
+            )
+            conn.commit()
+
+    def count(self, run_id: str) -> int:
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT COUNT(*) FROM document_partials WHERE run_id = ?", (run_id,)
+            ).fetchone()
+        return row[0]
+
+    def delete_run(self, run_id: str) -> None:
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("DELETE FROM document_partials WHERE run_id = ?", (run_id,))
+            conn.commit()
+
+    def touch_run(self, run_id: str) -> None:
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO discovery_runs (run_id, updated_at) VALUES (?, ?)",
+                (run_id, time.time()),
+            )
+            conn.commit()
+
+    def expire_runs(self, cutoff: float) -> List[str]:
+        """Forget runs idle since before `cutoff` and partials written before it; returns the run ids."""
+        with self._lock:
+            conn = self._get_conn()
+            run_ids = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT run_id FROM discovery_runs WHERE updated_at < ?", (cutoff,)
+                ).fetchall()
+            ]
+            conn.executemany("DELETE FROM discovery_runs WHERE run_id = ?", [(r,) for r in run_ids])
+            conn.execute("DELETE FROM document_partials WHERE created_at < ?", (cutoff,))
+            conn.commit()
+        return run_ids
+
+
+document_partials = DocumentPartialStore()
+
+
+def prune_expired_runs(max_age: float = SCHEMA_CHECKPOINT_TTL) -> int:
+    """Delete the checkpoints and partials of runs idle for longer than max_age seconds."""
+    run_ids = document_partials.expire_runs(time.time() - max_age)
+    checkpointer = get_checkpointer()
+    for run_id in run_ids:
+        checkpointer.delete_thread(run_id)
+    if run_ids:
+        print(f"🧹 PRUNED {len(run_ids)} expired discovery run(s)")
+    return len(run_ids)
+
+
+def record_run_activity(run_id: str) -> None:
+    """Mark a run as just started/resumed; expired runs are pruned at most hourly."""
+    global _last_prune
+    document_partials.touch_run(run_id)
+    if SCHEMA_CHECKPOINT_TTL <= 0 or time.time() - _last_prune < CHECKPOINT_PRUNE_INTERVAL:
+        return
+    _last_prune = time.time()
+    try:
+        prune_expired_runs()
+    except Exception as e:
+        print(f"⚠️ Discovery checkpoint pruning failed: {e}")
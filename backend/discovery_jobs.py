@@ -0,0 +1,234 @@
+"""
+Background schema-discovery jobs.
+
+Discovery runs on its own bounded thread pool instead of inside the HTTP
+request. Submissions are single-flight: while a run for the same key (user +
+discovery cache key) is queued or running, identical submissions attach to it
+and get the same job back instead of paying for the LLM work again.
+
+The pool is threads in the web server process: it bounds concurrent runs but
+does not isolate them from request handling (CPU-heavy nodes still share the
+GIL). When DISCOVERY_MAX_PENDING_JOBS runs are queued or running, submit
+raises JobQueueFull, which the endpoints (/discover-schema included) answer
+with 429 instead of starting another run.
+
+Jobs are looked up by id and owner; a job submitted without a user can only
+be awaited through its future, never fetched by id.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+DISCOVERY_JOB_WORKERS = int(os.getenv("DISCOVERY_JOB_WORKERS", "2"))
+DISCOVERY_MAX_PENDING_JOBS = int(os.getenv("DISCOVERY_MAX_PENDING_JOBS", "20"))
+DISCOVERY_JOB_RETENTION = int(os.getenv("DISCOVERY_JOB_RETENTION_SECONDS", "3600"))
+# Finished jobs kept for polling, at most; the oldest go first
+DISCOVERY_MAX_RETAINED_JOBS = int(os.getenv("DISCOVERY_MAX_RETAINED_JOBS", "200"))
+
+# Dropped from a finished job's result: the caller's LLM clients and token must
+# not stay alive, and the documents' markdown is not needed for the response
+_UNRETAINED_RESULT_KEYS = ("llm_instance", "llm_routes", "jwt_token", "documents", "doc_paths")
+
+
+class JobQueueFull(Exception):
+    """Raised when the pool already has DISCOVERY_MAX_PENDING_JOBS queued or running."""
+
+
+class DiscoveryJob:
+    def __init__(
+        self,
+        key: str,
+        owner_id: Optional[str],
+        node_names: List[str],
+        documents: int,
+        context: Optional[Dict[str, Any]] = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.owners = {owner_id}
+        # caller data needed to build the response (tables, key info)
+        self.context = context or {}
+        self.status = "queued"  # queued -> running -> succeeded | failed
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.nodes: Dict[str, Dict[str, Any]] = {name: {"status": "pending"} for name in node_names}
+        self.documents = documents
+        self.documents_mapped = 0
+        self.coalesced = 0
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.future: Future = Future()
+        self._node_started = time.time()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def _mark_node(self, name: str) -> None:
+        now = time.time()
+        node = self.nodes.setdefault(name, {})
+        node.update(status="done", seconds=round(now - self._node_started, 3))
+        self._node_started = now
+        # A node guessed as running but passed over was skipped by a conditional edge
+        for other in self.nodes.values():
+            if other["status"] == "running":
+                other["status"] = "skipped"
+        # The next pending node in graph order is the one now running
+        for other in self.nodes.values():
+            if other["status"] == "pending":
+                other["status"] = "running"
+                break
+
+    def to_dict(self) -> Dict[str, Any]:
+        ran = [name for name, node in self.nodes.items() if node["status"] != "pending"]
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_seconds": round((self.finished_at or time.time()) - (self.started_at or self.created_at), 3),
+            "progress": {
+                "nodes": self.nodes,
+                "current_node": next(
+                    (name for name, node in self.nodes.items() if node["status"] == "running"), None
+                ),
+                "nodes_completed": sum(1 for node in self.nodes.values() if node["status"] == "done"),
+                "nodes_started": len(ran),
+                "documents": self.documents,
+                "documents_mapped": self.documents_mapped,
+            },
+            "coalesced_requests": self.coalesced,
+            "error": self.error,
+        }
+
+
+class DiscoveryJobManager:
+    def __init__(
+        self,
+        workflow: Any,
+        node_names: List[str],
+        max_workers: int = DISCOVERY_JOB_WORKERS,
+        max_pending: int = DISCOVERY_MAX_PENDING_JOBS,
+        retention_seconds: int = DISCOVERY_JOB_RETENTION,
+        max_retained: int = DISCOVERY_MAX_RETAINED_JOBS,
+    ):
+        self.workflow = workflow
+        self.node_names = node_names
+        self.max_pending = max_pending
+        self.retention_seconds = retention_seconds
+        self.max_retained = max_retained
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="discovery-job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, DiscoveryJob] = {}
+        self._inflight: Dict[str, DiscoveryJob] = {}
+
+    def submit(
+        self,
+        key: str,
+        owner_id: Optional[str],
+        initial_state: Dict[str, Any],
+        context: Optional[Dict[str, Any]] = None,
+    ) -> DiscoveryJob:
+        """
+        Start a run for `key`, or return the queued/running job for that key
+        (its `coalesced` count goes up). Raises JobQueueFull when saturated.
+        """
+        with self._lock:
+            self._prune()
+            job = self._inflight.get(key)
+            if job is not None:
+                job.coalesced += 1
+                job.owners.add(owner_id)
+                print(f"🔗 JOB COALESCED: {key[:8]} -> {job.id[:8]} ({job.coalesced} extra)")
+                return job
+
+            if len(self._inflight) >= self.max_pending:
+                raise JobQueueFull(f"{len(self._inflight)} discovery jobs already pending")
+
+            job = DiscoveryJob(
+                key, owner_id, self.node_names, len(initial_state.get("documents", [])), context
+            )
+            self._jobs[job.id] = job
+            self._inflight[key] = job
+
+        self._executor.submit(self._run, job, initial_state)
+        print(f"🧵 JOB QUEUED: {job.id[:8]} ({key[:8]})")
+        return job
+
+    def get(self, job_id: str, owner_id: Optional[str]) -> Optional[DiscoveryJob]:
+        """The job if `owner_id` submitted it; None for anonymous callers (an id alone is no proof)."""
+        job = self._jobs.get(job_id)
+        if job is None or owner_id is None or owner_id not in job.owners:
+            return None
+        return job
+
+    def _run(self, job: DiscoveryJob, initial_state: Dict[str, Any]) -> None:
+        job.status = "running"
+        job.started_at = job._node_started = time.time()
+        if self.node_names:
+            job.nodes[self.node_names[0]]["status"] = "running"
+
+        result: Dict[str, Any] = dict(initial_state)
+        try:
+            for mode, chunk in self.workflow.stream(initial_state, stream_mode=["updates", "custom"]):
+                if mode == "custom":
+                    if chunk.get("type") == "partial_schema":
+                        job.documents_mapped += 1
+                    continue
+                for node_name, update in (chunk or {}).items():
+                    job._mark_node(node_name)
+                    if update:
+                        result.update(update)
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+            print(f"❌ JOB FAILED: {job.id[:8]}: {e}")
+        else:
+            for node in job.nodes.values():
+                if node["status"] != "done":
+                    node["status"] = "skipped"
+            job.result = result
+            job.status = "succeeded"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if self._inflight.get(job.key) is job:
+                    del self._inflight[job.key]
+                self._prune()
+            if job.result is not None:
+                for key in _UNRETAINED_RESULT_KEYS:
+                    job.result.pop(key, None)
+            if job.error:
+                job.future.set_exception(RuntimeError(job.error))
+            else:
+                job.future.set_result(job.result)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.retention_seconds
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.done and job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        # Jobs are kept in submission order
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[: max(0, len(self._jobs) - self.max_retained)]:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            statuses: Dict[str, int] = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {
+                "jobs": len(self._jobs),
+                "pending": len(self._inflight),
+                "by_status": statuses,
+                "coalesced_requests": sum(job.coalesced for job in self._jobs.values()),
+            }
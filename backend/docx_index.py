@@ -0,0 +1,156 @@
+"""
+DOCX text index: parse a .docx once and locate many references in it.
+
+Every paragraph of the document (body, table cells, text boxes, headers and
+footers) is recorded with where it lives, and all paragraph texts are joined
+into one string with per-paragraph offsets, so a `MultiPatternMatcher` can
+find every reference in a single scan.
+"""
+import os
+from bisect import bisect_right
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from docx import Document
+from docx.document import Document as _Document
+from docx.oxml.ns import qn
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+
+from text_matcher import MultiPatternMatcher
+
+_TXBX_TAG = qn("w:txbxContent")
+_P_TAG = qn("w:p")
+_FALLBACK_TAG = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+
+def _iter_textbox_paragraphs(element, parent) -> Iterator[Paragraph]:
+    """
+    Paragraphs inside text boxes under `element`. Text boxes saved with a VML
+    fallback appear twice (mc:Choice and mc:Fallback); the fallback copy is skipped.
+    """
+    for txbx in element.iter(_TXBX_TAG):
+        ancestor = txbx.getparent()
+        in_fallback = False
+        while ancestor is not None:
+            if ancestor.tag == _FALLBACK_TAG:
+                in_fallback = True
+                break
+            ancestor = ancestor.getparent()
+        if in_fallback:
+            continue
+        for p in txbx.iter(_P_TAG):
+            yield Paragraph(p, parent)
+
+
+def _iter_cell_paragraphs(cell) -> Iterator[Paragraph]:
+    """Cell paragraphs, including those of tables nested in the cell."""
+    yield from cell.paragraphs
+    for nested in cell.tables:
+        for row in nested.rows:
+            for nested_cell in row.cells:
+                yield from _iter_cell_paragraphs(nested_cell)
+
+
+def _iter_table_paragraphs(table: Table) -> Iterator[Tuple[int, int, Paragraph]]:
+    """(row, col, paragraph); a merged cell is visited once, at its first column."""
+    for row_idx, row in enumerate(table.rows):
+        seen = set()
+        for col_idx, cell in enumerate(row.cells):
+            if id(cell._tc) in seen:
+                continue
+            seen.add(id(cell._tc))
+            for para in _iter_cell_paragraphs(cell):
+                yield row_idx, col_idx, para
+
+
+class DocxTextIndex:
+    """
+    Paragraph texts of one DOCX with their positions:
+      - "paragraph": body paragraph (paragraph_index as in doc.paragraphs)
+      - "table_cell": table_index / row / col as in doc.tables (what table edits use)
+      - "textbox": paragraph_index among text-box paragraphs
+      - "header" / "footer": section_index, paragraph_index within that part
+    """
+
+    def __init__(self, document: _Document, filename: str):
+        self.filename = filename
+        self.entries: List[Dict[str, Any]] = []
+        self._texts: List[str] = []
+
+        for para_idx, para in enumerate(document.paragraphs):
+            self._add(para.text, type="paragraph", paragraph_index=para_idx)
+
+        for table_idx, table in enumerate(document.tables):
+            for row_idx, col_idx, para in _iter_table_paragraphs(table):
+                self._add(para.text, type="table_cell", table_index=table_idx, row=row_idx, col=col_idx)
+
+        for para_idx, para in enumerate(_iter_textbox_paragraphs(document.element.body, document)):
+            self._add(para.text, type="textbox", paragraph_index=para_idx)
+
+        for section_idx, section in enumerate(document.sections):
+            for part_type, part in (("header", section.header), ("footer", section.footer)):
+                # a linked header/footer is the previous section's part again
+                if part.is_linked_to_previous:
+                    continue
+                paragraphs = list(part.paragraphs)
+                for table in part.tables:
+                    paragraphs.extend(para for _, _, para in _iter_table_paragraphs(table))
+                paragraphs.extend(_iter_textbox_paragraphs(part._element, part))
+                for para_idx, para in enumerate(paragraphs):
+                    self._add(para.text, type=part_type, section_index=section_idx, paragraph_index=para_idx)
+
+        # One searchable string; "\n" separators keep matches inside a paragraph
+        self.text = "\n".join(self._texts)
+        self._offsets: List[int] = []
+        offset = 0
+        for text in self._texts:
+            self._offsets.append(offset)
+            offset += len(text) + 1
+
+    def _add(self, text: Optional[str], **position: Any) -> None:
+        self.entries.append(position)
+        self._texts.append(text or "")
+
+    @classmethod
+    def from_path(cls, path: str) -> "DocxTextIndex":
+        return cls(Document(path), os.path.basename(path))
+
+    def locate(self, matcher: MultiPatternMatcher) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        {reference: [location, ...]} for every occurrence of every pattern in
+        `matcher`. char_start/char_end are offsets within the paragraph;
+        doc_char_start is the offset in the index text.
+        """
+        results: Dict[str, List[Dict[str, Any]]] = {}
+        if not matcher or not self.text:
+            return results
+
+        for doc_char_start, reference in matcher.iter_matches(self.text):
+            entry_idx = bisect_right(self._offsets, doc_char_start) - 1
+            if doc_char_start + len(reference) > self._offsets[entry_idx] + len(self._texts[entry_idx]):
+                continue  # spans a paragraph boundary
+            char_start = doc_char_start - self._offsets[entry_idx]
+            results.setdefault(reference, []).append(
+                {
+                    "filename": self.filename,
+                    **self.entries[entry_idx],
+                    "char_start": char_start,
+                    "char_end": char_start + len(reference),
+                    "doc_char_start": doc_char_start,
+                    "text": reference,
+                }
+            )
+        return results
+
+
+def build_docx_indexes(paths: List[str]) -> Dict[str, DocxTextIndex]:
+    """One index per readable path; unreadable or missing files are skipped."""
+    indexes: Dict[str, DocxTextIndex] = {}
+    for path in dict.fromkeys(paths):
+        if not os.path.exists(path):
+            continue
+        try:
+            indexes[path] = DocxTextIndex.from_path(path)
+        except Exception as e:
+            print(f"⚠️ Could not index DOCX {os.path.basename(path)}: {e}")
+    return indexes
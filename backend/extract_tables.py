@@ -10,6 +10,9 @@ def extract_tables_from_docx_bytes(file_bytes: bytes) -> List[Dict[str, Any]]:
     For each cell, keep:
       - raw_paragraphs: list of paragraph texts (per bullet/line)
       - display_text: paragraphs joined with '\n' for frontend grid
+      - origin column: python-docx repeats a horizontally merged cell in
+        every column it spans; `merged` holds, per row, the first column of
+        the cell found at each column
 
     The backend can later reconstruct the exact old_value/new_value by
     joining raw_paragraphs with '\n'.
@@ -21,12 +24,16 @@ def extract_tables_from_docx_bytes(file_bytes: bytes) -> List[Dict[str, Any]]:
         for i, table in enumerate(doc.tables):
             table_preview: List[List[str]] = []
             table_paragraphs: List[List[List[str]]] = []  # [row][col][para_text]
+            table_merged: List[List[int]] = []  # [row][col] -> first column of that cell
 
             for row in table.rows:
                 row_preview: List[str] = []
                 row_paragraphs: List[List[str]] = []
+                row_merged: List[int] = []
+                first_col: Dict[int, int] = {}
 
-                for cell in row.cells:
+                for col_idx, cell in enumerate(row.cells):
+                    row_merged.append(first_col.setdefault(id(cell._tc), col_idx))
                     paras = [p.text or "" for p in cell.paragraphs]
 
                     # Normalise whitespace, but keep paragraph boundaries
@@ -43,6 +50,7 @@ def extract_tables_from_docx_bytes(file_bytes: bytes) -> List[Dict[str, Any]]:
 
                 table_preview.append(row_preview)
                 table_paragraphs.append(row_paragraphs)
+                table_merged.append(row_merged)
 
             if table_preview:
                 tables.append({
@@ -52,6 +60,7 @@ def extract_tables_from_docx_bytes(file_bytes: bytes) -> List[Dict[str, Any]]:
                     "preview": table_preview,
                     # raw paragraphs per cell so you can reconstruct full text
                     "paragraphs": table_paragraphs,
+                    "merged": table_merged,
                 })
 
         return tables
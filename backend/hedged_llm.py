@@ -0,0 +1,415 @@
+"""
+Hedged LLM Calls
+Races a user's configured providers for idempotent extraction calls (schema
+map, report inference, report resolve):
+  - the primary gets a head start of its recent p95 latency; if it has not
+    answered by then the next provider is started and the first answer wins
+  - a rate limit / 5xx / timeout starts the next provider immediately (failover)
+  - the loser is cancelled (ainvoke) or abandoned (invoke; a blocking HTTP
+    call cannot be interrupted from another thread). An abandoned call still
+    feeds the latency tracker when it ends and is passed to `on_abandoned`
+    (e.g. for the usage ledger); a cancelled one counts its elapsed time as a
+    latency sample, so the p95 is not computed on winners only
+
+Latency samples and win counts are per process; see hedge_stats.snapshot().
+"""
+import asyncio
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Any, Callable, Deque, Dict, NamedTuple, Optional, Sequence
+
+import numpy as np
+from langchain_core.runnables.config import ensure_config
+
+HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "false").lower() in ("1", "true", "yes")
+# Head start before the next provider is raced, until a model has enough samples for a p95
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_SECONDS", "5.0"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "0.5"))
+HEDGE_MAX_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MAX_DELAY_SECONDS", "30.0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MAX_FALLBACKS = int(os.getenv("LLM_HEDGE_MAX_FALLBACKS", "1"))
+HEDGE_MAX_WORKERS = int(os.getenv("LLM_HEDGE_MAX_WORKERS", "32"))
+HEDGE_LATENCY_PERCENTILE = 95
+HEDGE_LATENCY_WINDOW = 200
+
+# Model for a fallback provider whose key row has no model stored
+HEDGE_FALLBACK_MODELS: Dict[str, str] = {
+    "openai": "gpt-4o-mini",
+    "gemini": "gemini-1.5-flash",
+    "groq": "llama-3.3-70b-versatile",
+}
+
+_RETRYABLE_STATUS = {408, 409, 429}
+# OpenAI/Groq style messages: "Error code: 429 - {...}"
+_STATUS_IN_MESSAGE_RE = re.compile(r"error code:\s*(\d{3})\b")
+_RETRYABLE_MARKERS = (
+    "rate limit",
+    "rate_limit",
+    "too many requests",
+    "resource exhausted",
+    "resourceexhausted",
+    "overloaded",
+    "service unavailable",
+    "timed out",
+    "timeout",
+    "connection",
+)
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    for attr in ("status_code", "code", "http_status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    value = getattr(getattr(error, "response", None), "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """Rate limits, server errors, timeouts and dropped connections: another provider may answer."""
+    status = _status_code(error)
+    if status is None:
+        match = _STATUS_IN_MESSAGE_RE.search(str(error).lower())
+        status = int(match.group(1)) if match else None
+    if status is not None:
+        return status in _RETRYABLE_STATUS or status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    text = f"{type(error).__name__}: {error}".lower()
+    return any(m in text for m in _RETRYABLE_MARKERS)
+
+
+class LLMCandidate(NamedTuple):
+    provider: str
+    model: Optional[str]
+    llm: Any
+    # called (off the request thread) when a race actually starts this candidate, e.g. a key audit
+    on_start: Optional[Callable[[], None]] = None
+
+    @property
+    def label(self) -> str:
+        return f"{self.provider}/{self.model or 'default'}"
+
+
+class LatencyTracker:
+    """Recent successful call latencies per provider/model."""
+
+    def __init__(self, window: int = HEDGE_LATENCY_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, label: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(label, deque(maxlen=self.window)).append(seconds)
+
+    def hedge_delay(self, label: str) -> float:
+        with self._lock:
+            samples = list(self._samples.get(label, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SECONDS
+        p95 = float(np.percentile(samples, HEDGE_LATENCY_PERCENTILE))
+        return min(HEDGE_MAX_DELAY_SECONDS, max(HEDGE_MIN_DELAY_SECONDS, p95))
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            items = {label: list(samples) for label, samples in self._samples.items()}
+        return {
+            label: {
+                "samples": len(samples),
+                "p50_s": round(float(np.percentile(samples, 50)), 3),
+                "p95_s": round(float(np.percentile(samples, HEDGE_LATENCY_PERCENTILE)), 3),
+                "hedge_delay_s": round(self.hedge_delay(label), 3),
+            }
+            for label, samples in items.items()
+            if samples
+        }
+
+
+class HedgeStats:
+    """Per primary model: calls, who won, and how often hedging / failover kicked in."""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._wins: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, primary: str, winner: Optional[str], hedged: bool, failovers: int) -> None:
+        with self._lock:
+            s = self._stats.setdefault(
+                primary,
+                {"calls": 0, "primary_wins": 0, "fallback_wins": 0, "hedged": 0, "hedged_fallback_wins": 0, "failovers": 0, "failures": 0},
+            )
+            s["calls"] += 1
+            s["hedged"] += int(hedged)
+            s["failovers"] += failovers
+            if winner is None:
+                s["failures"] += 1
+            elif winner == primary:
+                s["primary_wins"] += 1
+            else:
+                s["fallback_wins"] += 1
+                s["hedged_fallback_wins"] += int(hedged)
+            if winner is not None:
+                self._wins[winner] = self._wins.get(winner, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {primary: dict(s) for primary, s in self._stats.items()}
+            wins = dict(self._wins)
+        for s in stats.values():
+            s["primary_win_rate"] = round(s["primary_wins"] / s["calls"], 4) if s["calls"] else 0.0
+            # of the races started by the hedge delay, the share the fallback won
+            s["hedge_win_rate"] = round(s["hedged_fallback_wins"] / s["hedged"], 4) if s["hedged"] else 0.0
+        return {"enabled": HEDGING_ENABLED, "by_primary": stats, "wins": wins, "latency": latency_tracker.snapshot()}
+
+
+latency_tracker = LatencyTracker()
+hedge_stats = HedgeStats()
+_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="llm-hedge")
+
+# (loser candidate, its response, seconds it took): an abandoned call that still finished
+AbandonedCallback = Callable[[LLMCandidate, Any, float], None]
+
+
+def _run_on_start(candidate: LLMCandidate) -> None:
+    try:
+        candidate.on_start()
+    except Exception as e:
+        print(f"  ⚠️ on_start of {candidate.label} failed: {e}")
+
+
+class _Race:
+    """Bookkeeping for one hedged call, shared by invoke and ainvoke."""
+
+    def __init__(self, candidates: Sequence[LLMCandidate], on_abandoned: Optional[AbandonedCallback] = None):
+        self.candidates = candidates
+        self.on_abandoned = on_abandoned
+        self.next_idx = 0
+        self.last_started = 0.0
+        self.last_label = ""
+        self.hedged = False
+        self.failovers = 0
+        self.error: Optional[BaseException] = None
+
+    def next_candidate(self) -> Optional[LLMCandidate]:
+        if self.next_idx >= len(self.candidates):
+            return None
+        candidate = self.candidates[self.next_idx]
+        self.next_idx += 1
+        self.last_started = time.perf_counter()
+        self.last_label = candidate.label
+        if candidate.on_start is not None:
+            _executor.submit(_run_on_start, candidate)
+        return candidate
+
+    def hedge_timeout(self) -> Optional[float]:
+        """Seconds until the next provider should be raced (None: no provider left)."""
+        if self.next_idx >= len(self.candidates):
+            return None
+        return max(0.0, self.last_started + latency_tracker.hedge_delay(self.last_label) - time.perf_counter())
+
+    def on_error(self, candidate: LLMCandidate, error: BaseException) -> bool:
+        """True if the next provider should be started now."""
+        self.error = error
+        retry = is_retryable_error(error) and self.next_idx < len(self.candidates)
+        print(f"  ⚠️ LLM {candidate.label} failed{' — failing over' if retry else ''}: {error}")
+        self.failovers += int(retry)
+        return retry
+
+    def on_success(self, candidate: LLMCandidate, started: float, result: Any) -> Any:
+        latency_tracker.record(candidate.label, time.perf_counter() - started)
+        hedge_stats.record(self.candidates[0].label, candidate.label, self.hedged, self.failovers)
+        metadata = getattr(result, "response_metadata", None)
+        if isinstance(metadata, dict):
+            metadata["hedge"] = {
+                "provider": candidate.provider,
+                "model": candidate.model,
+                "hedged": self.hedged,
+                "failovers": self.failovers,
+            }
+        return result
+
+    def on_cancelled(self, candidate: LLMCandidate, started: float) -> None:
+        """A loser cancelled mid-call: it took at least this long (a censored sample, never a low one)."""
+        latency_tracker.record(candidate.label, time.perf_counter() - started)
+
+    def on_abandoned_done(self, candidate: LLMCandidate, started: float, future: Any) -> None:
+        """Done callback of a loser left running (invoke): its real latency, and its cost."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        seconds = time.perf_counter() - started
+        latency_tracker.record(candidate.label, seconds)
+        if self.on_abandoned is not None:
+            try:
+                self.on_abandoned(candidate, future.result(), seconds)
+            except Exception as e:
+                print(f"  ⚠️ Could not record abandoned call to {candidate.label}: {e}")
+
+    @staticmethod
+    def config_for(candidate: LLMCandidate, config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        The caller's config (or the one in context) with the candidate in its
+        metadata, so callbacks such as the usage ledger charge whoever ran.
+        """
+        config = ensure_config(config)
+        metadata = {**config.get("metadata", {}), "hedge": {"provider": candidate.provider, "model": candidate.model}}
+        return {**config, "metadata": metadata}
+
+    def fail(self) -> BaseException:
+        hedge_stats.record(self.candidates[0].label, None, self.hedged, self.failovers)
+        return self.error or RuntimeError("No LLM candidate available")
+
+
+class HedgedLLM:
+    """
+    A chat model facade over [primary, fallback, ...] LLMCandidates with the
+    invoke / ainvoke / with_structured_output surface the callers use.
+    """
+
+    def __init__(self, candidates: Sequence[LLMCandidate], on_abandoned: Optional[AbandonedCallback] = None):
+        if not candidates:
+            raise ValueError("HedgedLLM needs at least one candidate")
+        self.candidates = list(candidates)
+        self.on_abandoned = on_abandoned
+
+    @property
+    def primary(self) -> LLMCandidate:
+        return self.candidates[0]
+
+    def __getattr__(self, name: str) -> Any:
+        # model_name, temperature, ... of the primary
+        return getattr(self.candidates[0].llm, name)
+
+    def with_structured_output(self, schema: Any, **kwargs: Any) -> "HedgedLLM":
+        bound = [self.primary._replace(llm=self.primary.llm.with_structured_output(schema, **kwargs))]
+        for candidate in self.candidates[1:]:
+            try:
+                bound.append(candidate._replace(llm=candidate.llm.with_structured_output(schema, **kwargs)))
+            except Exception as e:  # provider without structured output: not raced
+                print(f"  ⚠️ {candidate.label} skipped for structured output: {e}")
+        return HedgedLLM(bound, self.on_abandoned)
+
+    def invoke(self, input: Any, config: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Any:
+        race = _Race(self.candidates, self.on_abandoned)
+        pending: Dict[Any, tuple] = {}
+
+        def start() -> None:
+            candidate = race.next_candidate()
+            if candidate is not None:
+                # on a pool thread: carry over this thread's context variables
+                future = _executor.submit(
+                    contextvars.copy_context().run,
+                    candidate.llm.invoke,
+                    input,
+                    race.config_for(candidate, config),
+                    **kwargs,
+                )
+                pending[future] = (candidate, race.last_started)
+
+        start()
+        while pending:
+            done, _ = wait(list(pending), timeout=race.hedge_timeout(), return_when=FIRST_COMPLETED)
+            if not done:
+                race.hedged = True
+                start()
+                continue
+            for future in done:
+                candidate, started = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if race.on_error(candidate, e):
+                        start()
+                    continue
+                for loser, (loser_candidate, loser_started) in pending.items():
+                    if not loser.cancel():
+                        loser.add_done_callback(
+                            partial(race.on_abandoned_done, loser_candidate, loser_started)
+                        )
+                return race.on_success(candidate, started, result)
+        raise race.fail()
+
+    async def ainvoke(self, input: Any, config: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Any:
+        race = _Race(self.candidates, self.on_abandoned)
+        pending: Dict[asyncio.Task, tuple] = {}
+
+        def start() -> None:
+            candidate = race.next_candidate()
+            if candidate is not None:
+                task = asyncio.ensure_future(
+                    candidate.llm.ainvoke(input, race.config_for(candidate, config), **kwargs)
+                )
+                pending[task] = (candidate, race.last_started)
+
+        start()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    list(pending), timeout=race.hedge_timeout(), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    race.hedged = True
+                    start()
+                    continue
+                for task in done:
+                    candidate, started = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        if race.on_error(candidate, e):
+                            start()
+                        continue
+                    for loser_candidate, loser_started in pending.values():
+                        race.on_cancelled(loser_candidate, loser_started)
+                    return race.on_success(candidate, started, result)
+            raise race.fail()
+        finally:
+            for loser in pending:
+                loser.cancel()
+
+
+def hedge_llm(
+    primary: LLMCandidate,
+    fallbacks: Sequence[LLMCandidate],
+    on_abandoned: Optional[AbandonedCallback] = None,
+) -> Any:
+    """A HedgedLLM over primary + fallbacks, or the primary LLM itself when there is nothing to race."""
+    fallbacks = [c for c in fallbacks if c.provider != primary.provider][:HEDGE_MAX_FALLBACKS]
+    if not HEDGING_ENABLED or not fallbacks:
+        return primary.llm
+    return HedgedLLM([primary, *fallbacks], on_abandoned)
+
+
+if __name__ == "__main__":
+    import random
+
+    class _DemoLLM:
+        def __init__(self, name: str, delay: float, fail_rate: float = 0.0):
+            self.name, self.delay, self.fail_rate = name, delay, fail_rate
+
+        def invoke(self, input: Any, config: Any = None, **kwargs: Any) -> str:
+            time.sleep(self.delay * random.uniform(0.5, 3.0))
+            if random.random() < self.fail_rate:
+                raise RuntimeError("Error code: 429 - rate limited")
+            return self.name
+
+    HEDGING_ENABLED = True
+    HEDGE_DEFAULT_DELAY_SECONDS = 0.2
+    HEDGE_MIN_DELAY_SECONDS = 0.05
+    HEDGE_MIN_SAMPLES = 10
+    llm = hedge_llm(
+        LLMCandidate("groq", "llama-3.3-70b-versatile", _DemoLLM("groq", 0.05, fail_rate=0.1)),
+        [LLMCandidate("openai", "gpt-4o-mini", _DemoLLM("openai", 0.08))],
+    )
+    start = time.perf_counter()
+    answers = [llm.invoke("hi") for _ in range(40)]
+    print(f"40 calls in {time.perf_counter() - start:.2f}s: {answers.count('groq')} groq, {answers.count('openai')} openai")
+    import json
+    print(json.dumps(hedge_stats.snapshot(), indent=2))
@@ -0,0 +1,433 @@
+"""
+LLM Usage Ledger
+Records every LLM call (provider, model, endpoint, tokens, latency, cache status)
+and summarizes latency percentiles and token spend per user and model.
+
+Writes never block a request: records go onto a bounded queue and a background
+thread inserts them into Supabase (`llm_usage_ledger`) in batches.
+"""
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+LEDGER_TABLE = "llm_usage_ledger"
+LEDGER_ENABLED = os.getenv("LLM_LEDGER_ENABLED", "true").lower() not in ("0", "false", "no")
+LEDGER_BATCH_SIZE = int(os.getenv("LLM_LEDGER_BATCH_SIZE", "50"))
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LLM_LEDGER_FLUSH_INTERVAL", "2.0"))
+LEDGER_MAX_QUEUE = int(os.getenv("LLM_LEDGER_MAX_QUEUE", "10000"))
+LEDGER_QUERY_LIMIT = 10000
+
+# USD per 1M tokens: model (or model prefix) -> {"input": ..., "output": ...}.
+# Extend or override with LLM_PRICING_JSON='{"my-model": {"input": 1.0, "output": 2.0}}'.
+DEFAULT_LLM_PRICING: Dict[str, Dict[str, float]] = {
+    "gpt-4o-mini": {"input": 0.15, "output": 0.60},
+    "gpt-4o": {"input": 2.50, "output": 10.00},
+    "gpt-4.1-mini": {"input": 0.40, "output": 1.60},
+    "gpt-4.1-nano": {"input": 0.10, "output": 0.40},
+    "gpt-4.1": {"input": 2.00, "output": 8.00},
+    "gemini-1.5-flash": {"input": 0.075, "output": 0.30},
+    "gemini-2.0-flash": {"input": 0.10, "output": 0.40},
+    "llama-3.3-70b-versatile": {"input": 0.59, "output": 0.79},
+    "llama-3.1-8b-instant": {"input": 0.05, "output": 0.08},
+}
+
+
+def load_pricing() -> Dict[str, Dict[str, float]]:
+    pricing = {model: dict(price) for model, price in DEFAULT_LLM_PRICING.items()}
+    raw = os.getenv("LLM_PRICING_JSON")
+    if raw:
+        try:
+            for model, price in json.loads(raw).items():
+                pricing[model] = {
+                    "input": float(price.get("input", 0.0)),
+                    "output": float(price.get("output", 0.0)),
+                }
+        except (ValueError, AttributeError, TypeError) as e:
+            print(f"⚠️ Ignoring invalid LLM_PRICING_JSON: {e}")
+    return pricing
+
+
+LLM_PRICING = load_pricing()
+
+
+def _model_price(model: Optional[str], pricing: Dict[str, Dict[str, float]]) -> Optional[Dict[str, float]]:
+    """Exact model match first, then the longest matching prefix (dated model versions)."""
+    if not model:
+        return None
+    if model in pricing:
+        return pricing[model]
+    prefixes = [name for name in pricing if model.startswith(name)]
+    return pricing[max(prefixes, key=len)] if prefixes else None
+
+
+def estimate_cost(
+    model: Optional[str],
+    input_tokens: int,
+    output_tokens: int,
+    pricing: Optional[Dict[str, Dict[str, float]]] = None,
+) -> Dict[str, Any]:
+    price = _model_price(model, pricing or LLM_PRICING)
+    if price is None:
+        return {"input_cost_usd": 0.0, "output_cost_usd": 0.0, "total_cost_usd": 0.0, "priced": False}
+    input_cost = input_tokens * price["input"] / 1_000_000
+    output_cost = output_tokens * price["output"] / 1_000_000
+    return {
+        "input_cost_usd": round(input_cost, 6),
+        "output_cost_usd": round(output_cost, 6),
+        "total_cost_usd": round(input_cost + output_cost, 6),
+        "priced": True,
+    }
+
+
+def ledger_user_id(user_id: Optional[str]) -> Optional[str]:
+    """The user id as a UUID string, or None for ids the uuid column would reject ("anonymous")."""
+    if not user_id:
+        return None
+    try:
+        return str(UUID(str(user_id)))
+    except ValueError:
+        return None
+
+
+def _supabase_writer(rows: List[Dict[str, Any]]) -> None:
+    # Imported lazily so modules that only record usage don't need Supabase configured at import
+    from storage_service import base_supabase
+
+    base_supabase.table(LEDGER_TABLE).insert(rows).execute()
+
+
+class LLMUsageLedger:
+    """
+    Bounded queue + one daemon flush thread (started on first record).
+    A full queue or a failed insert drops records rather than slowing requests.
+    """
+
+    def __init__(
+        self,
+        writer: Callable[[List[Dict[str, Any]]], None] = _supabase_writer,
+        batch_size: int = LEDGER_BATCH_SIZE,
+        flush_interval: float = LEDGER_FLUSH_INTERVAL,
+        max_queue: int = LEDGER_MAX_QUEUE,
+        enabled: bool = LEDGER_ENABLED,
+    ):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.counters = {"recorded": 0, "written": 0, "dropped": 0, "write_errors": 0}
+
+    def record(
+        self,
+        *,
+        user_id: Optional[str],
+        provider: Optional[str],
+        model: Optional[str],
+        endpoint: str,
+        input_tokens: Optional[int] = None,
+        output_tokens: Optional[int] = None,
+        latency_ms: Optional[float] = None,
+        cache_status: str = "miss",
+        token_source: Optional[str] = None,
+        status: str = "ok",
+    ) -> None:
+        if not self.enabled:
+            return
+        # One non-UUID user id would fail the whole batch insert
+        row = {
+            "user_id": ledger_user_id(user_id),
+            "provider": provider,
+            "model": model,
+            "endpoint": endpoint,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "latency_ms": round(latency_ms, 1) if latency_ms is not None else None,
+            "cache_status": cache_status,
+            "token_source": token_source,
+            "status": status,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        try:
+            self._queue.put_nowait(row)
+            self.counters["recorded"] += 1
+        except queue.Full:
+            self.counters["dropped"] += 1
+            return
+        self._ensure_worker()
+
+    def _ensure_worker(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="llm-ledger-flush", daemon=True
+                )
+                self._thread.start()
+
+    def _drain(self, first: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        batch = [first] if first is not None else []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        if not batch:
+            return
+        with self._write_lock:
+            try:
+                self.writer(batch)
+                self.counters["written"] += len(batch)
+            except Exception as e:
+                self.counters["write_errors"] += 1
+                self.counters["dropped"] += len(batch)
+                print(f"⚠️ LLM ledger write failed ({len(batch)} records dropped): {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            # Give a burst of calls a moment to land in the same batch
+            if self._queue.qsize() < self.batch_size - 1:
+                time.sleep(min(0.2, self.flush_interval))
+            self._write(self._drain(first))
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Write everything queued so far, including a batch the worker holds (used at shutdown)."""
+        while not self._queue.empty():
+            self._write(self._drain())
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "queued": self._queue.qsize(), "enabled": self.enabled}
+
+
+llm_ledger = LLMUsageLedger()
+atexit.register(llm_ledger.flush)
+
+
+def usage_from_llm_result(response: LLMResult) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    """(input_tokens, output_tokens, model_name) from a LangChain LLMResult, where reported."""
+    input_tokens = output_tokens = None
+    for generations in response.generations or []:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                input_tokens = (input_tokens or 0) + int(usage.get("input_tokens") or 0)
+                output_tokens = (output_tokens or 0) + int(usage.get("output_tokens") or 0)
+
+    llm_output = response.llm_output or {}
+    if input_tokens is None:
+        token_usage = llm_output.get("token_usage") or llm_output.get("usage") or {}
+        if token_usage.get("prompt_tokens") is not None:
+            input_tokens = int(token_usage.get("prompt_tokens") or 0)
+            output_tokens = int(token_usage.get("completion_tokens") or 0)
+    return input_tokens, output_tokens, llm_output.get("model_name") or llm_output.get("model")
+
+
+def abandoned_call_recorder(
+    user_id: Optional[str], endpoint: str, ledger: Optional[LLMUsageLedger] = None
+) -> Callable[[Any, Any, float], None]:
+    """
+    on_abandoned hook for hedged_llm: ledgers a call that lost a hedge race
+    but still finished (and is billed), with the tokens its provider reported.
+    """
+
+    def record(candidate: Any, response: Any, seconds: float) -> None:
+        usage = getattr(response, "usage_metadata", None) or {}
+        input_tokens = usage.get("input_tokens")
+        (ledger or llm_ledger).record(
+            user_id=user_id,
+            provider=candidate.provider,
+            model=candidate.model,
+            endpoint=endpoint,
+            input_tokens=input_tokens,
+            output_tokens=usage.get("output_tokens"),
+            latency_ms=seconds * 1000,
+            token_source="provider" if input_tokens is not None else None,
+            status="abandoned",
+        )
+
+    return record
+
+
+class LedgerCallbackHandler(BaseCallbackHandler):
+    """
+    Records each chat-model call made under a runnable config to the ledger.
+    Pass it as `config={"callbacks": [handler]}`; provider/model come from the
+    hedge candidate that ran the call, then from what LangChain reports in the
+    run metadata (ls_provider / ls_model_name), then from the constructor.
+    """
+
+    def __init__(
+        self,
+        user_id: Optional[str],
+        endpoint: str,
+        provider: Optional[str] = None,
+        model: Optional[str] = None,
+        ledger: Optional[LLMUsageLedger] = None,
+    ):
+        self.user_id = user_id
+        self.endpoint = endpoint
+        self.provider = provider
+        self.model = model
+        self.ledger = ledger or llm_ledger
+        self._runs: Dict[UUID, Tuple[float, Optional[str], Optional[str]]] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata=None, **kwargs) -> None:
+        metadata = metadata or {}
+        # a hedged call: the candidate that made this run (see hedged_llm)
+        hedge = metadata.get("hedge") or {}
+        self._runs[run_id] = (
+            time.perf_counter(),
+            hedge.get("provider") or metadata.get("ls_provider") or self.provider,
+            hedge.get("model") or metadata.get("ls_model_name") or self.model,
+        )
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, metadata=None, **kwargs) -> None:
+        self.on_chat_model_start(serialized, [], run_id=run_id, metadata=metadata)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs) -> None:
+        started, provider, model = self._runs.pop(run_id, (None, self.provider, self.model))
+        input_tokens, output_tokens, reported_model = usage_from_llm_result(response)
+        self.ledger.record(
+            user_id=self.user_id,
+            provider=provider,
+            model=reported_model or model,
+            endpoint=self.endpoint,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            latency_ms=(time.perf_counter() - started) * 1000 if started else None,
+            cache_status="miss",
+            token_source="provider" if input_tokens is not None else None,
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        started, provider, model = self._runs.pop(run_id, (None, self.provider, self.model))
+        self.ledger.record(
+            user_id=self.user_id,
+            provider=provider,
+            model=model,
+            endpoint=self.endpoint,
+            latency_ms=(time.perf_counter() - started) * 1000 if started else None,
+            cache_status="miss",
+            status="error",
+        )
+
+
+def _percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return round(sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo), 1)
+
+
+def summarize_llm_usage(
+    rows: List[Dict[str, Any]],
+    pricing: Optional[Dict[str, Dict[str, float]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Group ledger rows by (user_id, model): call counts, cache hits, errors,
+    p50/p95 latency (LLM calls only — cache hits cost no latency) and token spend.
+    """
+    groups: Dict[Tuple[Any, Any], Dict[str, Any]] = {}
+    for row in rows:
+        key = (row.get("user_id"), row.get("model"))
+        group = groups.setdefault(
+            key,
+            {
+                "user_id": key[0],
+                "provider": row.get("provider"),
+                "model": key[1],
+                "calls": 0,
+                "cache_hits": 0,
+                "errors": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "endpoints": {},
+                "_latencies": [],
+            },
+        )
+        if row.get("cache_status") == "hit":
+            group["cache_hits"] += 1
+            continue
+        group["calls"] += 1
+        endpoint = row.get("endpoint") or "unknown"
+        group["endpoints"][endpoint] = group["endpoints"].get(endpoint, 0) + 1
+        if row.get("status") == "error":
+            group["errors"] += 1
+        group["input_tokens"] += int(row.get("input_tokens") or 0)
+        group["output_tokens"] += int(row.get("output_tokens") or 0)
+        if row.get("latency_ms") is not None:
+            group["_latencies"].append(float(row["latency_ms"]))
+
+    summary = []
+    for group in groups.values():
+        latencies = sorted(group.pop("_latencies"))
+        group["p50_latency_ms"] = _percentile(latencies, 50)
+        group["p95_latency_ms"] = _percentile(latencies, 95)
+        group["total_tokens"] = group["input_tokens"] + group["output_tokens"]
+        group["cost"] = estimate_cost(group["model"], group["input_tokens"], group["output_tokens"], pricing)
+        summary.append(group)
+
+    summary.sort(key=lambda g: (str(g["user_id"]), -g["total_tokens"]))
+    return summary
+
+
+def query_llm_usage(
+    supabase: Any,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    limit: int = LEDGER_QUERY_LIMIT,
+) -> List[Dict[str, Any]]:
+    """Fetch ledger rows visible to `supabase` (RLS scopes a user client to its own rows)."""
+    query = supabase.table(LEDGER_TABLE).select(
+        "user_id, provider, model, endpoint, input_tokens, output_tokens, latency_ms, cache_status, status, created_at"
+    )
+    if start:
+        query = query.gte("created_at", start)
+    if end:
+        query = query.lte("created_at", end)
+    result = query.order("created_at", desc=True).limit(limit).execute()
+    return result.data or []
+
+
+if __name__ == "__main__":
+    written: List[Dict[str, Any]] = []
+    demo = LLMUsageLedger(writer=written.extend, flush_interval=0.1)
+    for latency in (420, 510, 380, 2900, 610):
+        demo.record(
+            user_id="demo-user", provider="groq", model="llama-3.3-70b-versatile",
+            endpoint="schema_map", input_tokens=1800, output_tokens=240, latency_ms=latency,
+        )
+    demo.record(user_id="demo-user", provider="groq", model="llama-3.3-70b-versatile",
+                endpoint="schema_map", cache_status="hit")
+    demo.flush()
+    print(f"Ledger counters: {demo.stats()}")
+    for row in summarize_llm_usage(written):
+        print(json.dumps(row, indent=2))
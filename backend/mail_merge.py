@@ -0,0 +1,277 @@
+"""
+Mail Merge
+One DOCX template x N rows of replacements -> a zip of N documents.
+
+  - each worker process parses the template once (pool initializer) and keeps
+    a pristine copy of <w:body>; a row gets a deep copy of that body, not a
+    re-parse of the package
+  - rows render in a process pool (python-docx edits are CPU bound), with a
+    bounded number of rows in flight
+  - the zip is written to a non-seekable sink and yielded entry by entry, so
+    memory stays at ~one window of documents regardless of N
+  - manifest.json (the last entry) has per-row file names, replacement
+    counts and errors
+"""
+import copy
+import json
+import multiprocessing
+import os
+import re
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from docx import Document
+
+from replace import apply_replacements_to_document, apply_table_edits
+
+MAIL_MERGE_WORKERS = int(os.getenv("MAIL_MERGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+MAIL_MERGE_MAX_ROWS = int(os.getenv("MAIL_MERGE_MAX_ROWS", "1000"))
+# Smaller batches render in-process; starting worker processes would cost more
+MAIL_MERGE_MIN_PARALLEL_ROWS = int(os.getenv("MAIL_MERGE_MIN_PARALLEL_ROWS", "8"))
+# Rendered rows waiting to be zipped, per worker
+MAIL_MERGE_WINDOW_PER_WORKER = 2
+
+_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+MANIFEST_NAME = "manifest.json"
+_UNSAFE_FILENAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]+')
+
+
+class TemplateRenderer:
+    """A parsed template whose body is cloned for every row."""
+
+    def __init__(self, template_bytes: bytes, filename: Optional[str] = None):
+        self.filename = filename
+        self._doc = Document(BytesIO(template_bytes))
+        self._part = self._doc.part
+        self._pristine_body = copy.deepcopy(self._part.element.body)
+
+    def render(
+        self,
+        replacements: List[Tuple[str, str]],
+        table_edits: Optional[List[Dict[str, Any]]] = None,
+        match_case: bool = True,
+    ) -> Tuple[bytes, int]:
+        """(docx bytes, replacements + table edits applied) for one row."""
+        document_element = self._part.element
+        document_element.replace(document_element.body, copy.deepcopy(self._pristine_body))
+        # a fresh Document proxy: python-docx caches the old <w:body> wrapper
+        doc = self._part.document
+        count = apply_table_edits(doc, table_edits, match_case, self.filename)
+        count += apply_replacements_to_document(doc, replacements, match_case)
+        stream = BytesIO()
+        doc.save(stream)
+        return stream.getvalue(), count
+
+
+# One renderer per worker process, built by the pool initializer
+_worker_renderer: Optional[TemplateRenderer] = None
+
+
+def _init_worker(template_bytes: bytes, filename: Optional[str]) -> None:
+    global _worker_renderer
+    _worker_renderer = TemplateRenderer(template_bytes, filename)
+
+
+def _render_with(
+    renderer: TemplateRenderer, row: Dict[str, Any], match_case: bool
+) -> Tuple[Optional[bytes], int, Optional[str]]:
+    try:
+        data, count = renderer.render(
+            [tuple(pair) for pair in row.get("replacements") or []],
+            row.get("table_edits") or [],
+            match_case,
+        )
+        return data, count, None
+    except Exception as e:
+        return None, 0, str(e)
+
+
+def _render_row(row: Dict[str, Any], match_case: bool) -> Tuple[Optional[bytes], int, Optional[str]]:
+    """Pool task: render with this worker's renderer."""
+    return _render_with(_worker_renderer, row, match_case)
+
+
+class _ChunkSink:
+    """Write-only, non-seekable file for zipfile; drain() hands over what was written."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def row_filename(row: Dict[str, Any], index: int, template_name: Optional[str], used: set) -> str:
+    stem = os.path.splitext(os.path.basename(template_name or "document.docx"))[0]
+    name = _UNSAFE_FILENAME_RE.sub("_", (row.get("name") or "").strip()).strip(". ")
+    name = f"{index + 1:03d}_{name or stem}"
+    candidate, n = f"{name}.docx", 2
+    while candidate in used:
+        candidate, n = f"{name}_{n}.docx", n + 1
+    used.add(candidate)
+    return candidate
+
+
+def zip_content_disposition(template_name: Optional[str]) -> str:
+    """
+    Content-Disposition for the merged zip: an ASCII filename for old clients
+    and filename* (RFC 5987) with the real, possibly non-Latin, template name.
+    """
+    stem = os.path.splitext(os.path.basename(template_name or "document.docx"))[0]
+    stem = _UNSAFE_FILENAME_RE.sub("_", stem).strip(". ") or "document"
+    name = f"{stem}_merged.zip"
+    ascii_name = name.encode("ascii", "replace").decode("ascii").replace("?", "_")
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(name)}"
+
+
+def _rendered_rows(
+    template_bytes: bytes,
+    rows: List[Dict[str, Any]],
+    template_name: Optional[str],
+    match_case: bool,
+    renderer: Optional[TemplateRenderer] = None,
+) -> Iterator[Tuple[Optional[bytes], int, Optional[str]]]:
+    """(docx bytes, count, error) per row, in row order."""
+    if len(rows) < MAIL_MERGE_MIN_PARALLEL_ROWS or MAIL_MERGE_WORKERS <= 1:
+        # a renderer of its own: concurrent merges in this process must not share one
+        renderer = renderer or TemplateRenderer(template_bytes, template_name)
+        for row in rows:
+            yield _render_with(renderer, row, match_case)
+        return
+
+    workers = min(MAIL_MERGE_WORKERS, len(rows))
+    window: Deque[Future] = deque()
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        # forking the (multi-threaded) server process is not safe
+        mp_context=multiprocessing.get_context(_START_METHOD),
+        initializer=_init_worker,
+        initargs=(template_bytes, template_name),
+    )
+
+    def submit(row: Dict[str, Any]) -> Future:
+        try:
+            return executor.submit(_render_row, row, match_case)
+        except BrokenProcessPool as e:
+            failed: Future = Future()
+            failed.set_exception(e)
+            return failed
+
+    try:
+        pending_rows = iter(rows)
+        for row in pending_rows:
+            window.append(submit(row))
+            if len(window) >= workers * MAIL_MERGE_WINDOW_PER_WORKER:
+                break
+        while window:
+            try:
+                result = window.popleft().result()
+            except BrokenProcessPool as e:
+                # a worker died (e.g. killed for memory): this and every later row fail
+                result = (None, 0, f"worker process died: {e}")
+            row = next(pending_rows, None)
+            if row is not None:
+                window.append(submit(row))
+            yield result
+    finally:
+        # client gone or an error: drop rows that have not started
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def stream_mail_merge_zip(
+    template_bytes: bytes,
+    rows: List[Dict[str, Any]],
+    template_name: Optional[str] = None,
+    match_case: bool = True,
+    renderer: Optional[TemplateRenderer] = None,
+) -> Iterator[bytes]:
+    """
+    Zip bytes for the merged documents, yielded one entry at a time, ending
+    with manifest.json. rows: [{"name", "replacements": [[old, new], ...],
+    "table_edits": [...]}]. A row that fails is listed with its error and
+    left out of the zip. Pass `renderer` (a TemplateRenderer of the same
+    template, e.g. built to validate it before the response starts) to reuse
+    the parsed template for in-process rendering.
+    """
+    started = time.perf_counter()
+    sink = _ChunkSink()
+    manifest_rows: List[Dict[str, Any]] = []
+    used_names: set = set()
+    # .docx files are already deflate-compressed
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for index, (row, (data, count, error)) in enumerate(
+            zip(rows, _rendered_rows(template_bytes, rows, template_name, match_case, renderer))
+        ):
+            entry: Dict[str, Any] = {"index": index, "name": row.get("name"), "replacements": count}
+            if error is None:
+                entry["file"] = row_filename(row, index, template_name, used_names)
+                archive.writestr(entry["file"], data)
+            else:
+                print(f"  💥 MAIL MERGE ROW {index + 1} FAILED: {error}")
+                entry["error"] = error
+            manifest_rows.append(entry)
+            yield sink.drain()
+
+        manifest = {
+            "template": template_name,
+            "rows": manifest_rows,
+            "documents": sum(1 for r in manifest_rows if "file" in r),
+            "failed": sum(1 for r in manifest_rows if "error" in r),
+            "total_replacements": sum(r["replacements"] for r in manifest_rows),
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+    print(
+        f"📨 MAIL MERGE: {manifest['documents']} docs, {manifest['failed']} failed, "
+        f"{manifest['total_replacements']} replacements in {manifest['seconds']}s"
+    )
+    yield sink.drain()
+
+
+if __name__ == "__main__":
+    template = Document()
+    template.add_paragraph("CERTIFICATE OF PARTICIPATION")
+    para = template.add_paragraph("This is to certify that ")
+    para.add_run("Ramesh Kumar").bold = True
+    para.add_run(" attended the Guest Lecture on Spring Boot.")
+    table = template.add_table(rows=1, cols=2)
+    table.cell(0, 0).text = "Roll No:"
+    table.cell(0, 1).text = "21CS045"
+    buffer = BytesIO()
+    template.save(buffer)
+
+    names = [f"Student {i}" for i in range(40)]
+    demo_rows = [
+        {
+            "name": name,
+            "replacements": [["Ramesh Kumar", name]],
+            "table_edits": [{"table_index": 0, "row": 0, "col": 1, "old_value": "21CS045", "new_value": f"21CS{i:03d}"}],
+        }
+        for i, name in enumerate(names)
+    ]
+    start = time.perf_counter()
+    zipped = b"".join(stream_mail_merge_zip(buffer.getvalue(), demo_rows, "certificate.docx"))
+    print(f"{len(zipped)} zip bytes in {time.perf_counter() - start:.2f}s")
+    with zipfile.ZipFile(BytesIO(zipped)) as archive:
+        first = Document(BytesIO(archive.read(archive.namelist()[0])))
+        print(archive.namelist()[:3], "...", archive.namelist()[-2:])
+        last = Document(BytesIO(archive.read(archive.namelist()[-2])))
+        print(last.paragraphs[1].text, "|", last.tables[0].cell(0, 1).text)
+        print(first.paragraphs[1].text, "|", first.tables[0].cell(0, 1).text)
+        print(json.loads(archive.read(MANIFEST_NAME))["rows"][:2])
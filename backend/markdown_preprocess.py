@@ -0,0 +1,285 @@
+"""
+Markdown pre-processing for the schema map prompt.
+
+Shrinks what is sent to the LLM without losing what it needs:
+  - pipe tables become a one-line summary (the prompt ignores tabular data)
+  - runs of spaces/tabs collapse to one space, blank-line runs to one blank line
+  - blocks repeated across the event's documents (letterheads, boilerplate)
+    are kept in the first document that has them and dropped from the others;
+    shared_block_documents says which documents a dropped block belongs to
+
+Every character copied from the input is recorded in an offset map, so a
+reference the LLM copies out of the processed text can be turned back into the
+exact substring of the original markdown.
+"""
+import os
+import re
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+PREPROCESS_ENABLED = os.getenv("SCHEMA_MAP_PREPROCESS", "true").lower() in ("1", "true", "yes")
+# Blocks shorter than this are never treated as shared boilerplate
+SHARED_BLOCK_MIN_CHARS = int(os.getenv("SHARED_BLOCK_MIN_CHARS", "20"))
+
+_WS_RUN_RE = re.compile(r"[ \t\u00a0]+")
+_NON_WS_RE = re.compile(r"[^ \t\u00a0]+")
+_TABLE_SEPARATOR_RE = re.compile(r"^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?\s*$")
+
+
+def _normalize_block(lines: List[str]) -> str:
+    return " ".join(_WS_RUN_RE.sub(" ", line).strip() for line in lines).strip()
+
+
+def _split_blocks(markdown: str) -> List[List[Tuple[int, str]]]:
+    """Blank-line separated blocks of (offset, line)."""
+    blocks: List[List[Tuple[int, str]]] = []
+    current: List[Tuple[int, str]] = []
+    offset = 0
+    for line in markdown.split("\n"):
+        if line.strip():
+            current.append((offset, line))
+        elif current:
+            blocks.append(current)
+            current = []
+        offset += len(line) + 1
+    if current:
+        blocks.append(current)
+    return blocks
+
+
+def _is_table_line(line: str) -> bool:
+    return line.lstrip().startswith("|")
+
+
+def _is_table_block(lines: List[str]) -> bool:
+    return len(lines) >= 2 and all(_is_table_line(line) for line in lines) and any(
+        _TABLE_SEPARATOR_RE.match(line.strip()) for line in lines
+    )
+
+
+def _table_summary(lines: List[str]) -> str:
+    headers = [cell.strip() for cell in lines[0].strip().strip("|").split("|")]
+    rows = sum(1 for line in lines[1:] if not _TABLE_SEPARATOR_RE.match(line.strip()))
+    return f"[table: {rows} rows; columns: {' | '.join(h for h in headers if h) or len(headers)}]"
+
+
+def _candidate_blocks(markdown: str) -> List[str]:
+    """Normalized blocks that may be shared boilerplate (tables are left to the table summary)."""
+    candidates = []
+    for block in _split_blocks(markdown):
+        lines = [line for _, line in block]
+        if _is_table_block(lines):
+            continue
+        normalized = _normalize_block(lines)
+        if len(normalized) >= SHARED_BLOCK_MIN_CHARS:
+            candidates.append(normalized)
+    return candidates
+
+
+def find_shared_blocks(markdowns: List[str]) -> List[Set[str]]:
+    """
+    For each document, the normalized blocks to drop: blocks that also occur
+    in an earlier document, or earlier in the same one.
+    """
+    seen: Set[str] = set()
+    drops: List[Set[str]] = []
+    for markdown in markdowns:
+        doc_drops: Set[str] = set()
+        for normalized in _candidate_blocks(markdown):
+            if normalized in seen:
+                doc_drops.add(normalized)
+            else:
+                seen.add(normalized)
+        drops.append(doc_drops)
+    return drops
+
+
+def shared_block_documents(markdowns: List[str], drops: List[Set[str]]) -> Dict[str, List[int]]:
+    """
+    Blocks dropped from at least one document -> indexes of every document
+    that contains them. The block's fields are only mapped in the first one,
+    but belong to all of them.
+    """
+    dropped = set().union(*drops) if drops else set()
+    owners: Dict[str, List[int]] = {}
+    for idx, markdown in enumerate(markdowns):
+        for normalized in _candidate_blocks(markdown):
+            if normalized in dropped:
+                doc_idxs = owners.setdefault(normalized, [])
+                if not doc_idxs or doc_idxs[-1] != idx:
+                    doc_idxs.append(idx)
+    return {block: doc_idxs for block, doc_idxs in owners.items() if len(doc_idxs) > 1}
+
+
+def normalize_reference(reference: str) -> str:
+    """A reference in the whitespace form of normalized blocks, for `in` checks against them."""
+    return " ".join(reference.split())
+
+
+class PreprocessedMarkdown:
+    """Processed text plus the segments of it that were copied from the original."""
+
+    def __init__(self, original: str):
+        self.original = original
+        self.text = ""
+        self.tables_summarized = 0
+        self.shared_blocks_removed = 0
+        self.dropped_blocks: Set[str] = set()
+        self._parts: List[str] = []
+        self._length = 0
+        # parallel arrays: processed start, original start, length
+        self._proc_starts: List[int] = []
+        self._orig_starts: List[int] = []
+        self._lengths: List[int] = []
+
+    def _copy(self, orig_start: int, text: str) -> None:
+        if not text:
+            return
+        if (
+            self._proc_starts
+            and self._proc_starts[-1] + self._lengths[-1] == self._length
+            and self._orig_starts[-1] + self._lengths[-1] == orig_start
+        ):
+            self._lengths[-1] += len(text)
+        else:
+            self._proc_starts.append(self._length)
+            self._orig_starts.append(orig_start)
+            self._lengths.append(len(text))
+        self._parts.append(text)
+        self._length += len(text)
+
+    def _synthetic(self, text: str) -> None:
+        self._parts.append(text)
+        self._length += len(text)
+
+    def _finish(self) -> "PreprocessedMarkdown":
+        self.text = "".join(self._parts)
+        self._parts = []
+        return self
+
+    def _to_original_offset(self, proc_offset: int) -> Optional[int]:
+        idx = bisect_right(self._proc_starts, proc_offset) - 1
+        if idx < 0 or proc_offset >= self._proc_starts[idx] + self._lengths[idx]:
+            return None
+        return self._orig_starts[idx] + proc_offset - self._proc_starts[idx]
+
+    def to_original(self, start: int, end: int) -> Optional[Tuple[int, int]]:
+        """Original span of processed text[start:end], or None if it touches generated text."""
+        if end <= start:
+            return None
+        orig_start = self._to_original_offset(start)
+        orig_last = self._to_original_offset(end - 1)
+        if orig_start is None or orig_last is None:
+            return None
+        return orig_start, orig_last + 1
+
+    def restore_reference(self, reference: str) -> str:
+        """The original-markdown spelling of a reference copied from the processed text."""
+        if not reference or reference in self.original:
+            return reference
+        start = self.text.find(reference)
+        if start == -1:
+            return reference
+        span = self.to_original(start, start + len(reference))
+        return self.original[span[0]:span[1]] if span else reference
+
+    def restore_schema(self, partial_schema: Dict[str, Any]) -> Dict[str, Any]:
+        for field_val in partial_schema.values():
+            if isinstance(field_val, dict) and field_val.get("references"):
+                field_val["references"] = list(
+                    dict.fromkeys(
+                        self.restore_reference(ref) if isinstance(ref, str) else ref
+                        for ref in field_val["references"]
+                    )
+                )
+        return partial_schema
+
+    def cache_identity(self) -> str:
+        """
+        What the processed text is a function of: the raw markdown and the
+        blocks dropped from it. Unlike the text itself, it does not change
+        when an unrelated document is added to or removed from the event.
+        """
+        return "\x00".join(
+            ["preprocess" if PREPROCESS_ENABLED else "raw", self.original, *sorted(self.dropped_blocks)]
+        )
+
+    def to_stats(self) -> Dict[str, Any]:
+        return {
+            "chars_raw": len(self.original),
+            "chars_sent": len(self.text),
+            "tables_summarized": self.tables_summarized,
+            "shared_blocks_removed": self.shared_blocks_removed,
+        }
+
+
+def preprocess_markdown(markdown: str, drop_blocks: Optional[Set[str]] = None) -> PreprocessedMarkdown:
+    """Summarize tables, collapse whitespace and drop `drop_blocks` (see find_shared_blocks)."""
+    result = PreprocessedMarkdown(markdown)
+    if not PREPROCESS_ENABLED:
+        result._copy(0, markdown)
+        return result._finish()
+
+    drop_blocks = drop_blocks or set()
+    first_block = True
+    for block in _split_blocks(markdown):
+        lines = [line for _, line in block]
+        normalized = _normalize_block(lines) if drop_blocks else ""
+        if normalized in drop_blocks:
+            result.shared_blocks_removed += 1
+            result.dropped_blocks.add(normalized)
+            continue
+        if not first_block:
+            result._synthetic("\n\n")
+        first_block = False
+
+        idx = 0
+        first_line = True
+        while idx < len(block):
+            # a run of table lines inside the block
+            end = idx
+            while end < len(block) and _is_table_line(block[end][1]):
+                end += 1
+            table_lines = [line for _, line in block[idx:end]]
+            if end > idx and _is_table_block(table_lines):
+                if not first_line:
+                    result._synthetic("\n")
+                result._synthetic(_table_summary(table_lines))
+                result.tables_summarized += 1
+                first_line = False
+                idx = end
+                continue
+
+            offset, line = block[idx]
+            if not first_line:
+                result._copy(offset - 1, "\n")
+            first_line = False
+            words = list(_NON_WS_RE.finditer(line))
+            for word_idx, word in enumerate(words):
+                if word_idx:
+                    # one space, mapped onto the first character of the original run
+                    result._copy(offset + words[word_idx - 1].end(), " ")
+                result._copy(offset + word.start(), word.group())
+            idx += 1
+
+    return result._finish()
+
+
+def preprocess_documents(markdowns: List[str]) -> List[PreprocessedMarkdown]:
+    """Pre-process an event's documents together, so shared blocks are sent once."""
+    drops = find_shared_blocks(markdowns) if PREPROCESS_ENABLED else [set()] * len(markdowns)
+    return [preprocess_markdown(md, doc_drops) for md, doc_drops in zip(markdowns, drops)]
+
+
+if __name__ == "__main__":
+    letterhead = "**GOVERNMENT ENGINEERING COLLEGE**\nDepartment of   Computer Science\nPhone: 0471-2345678"
+    docs = [
+        f"{letterhead}\n\n\n\nDear   Ramesh  Kumar,\n\nYour request dated 12/03/2024 is approved.\n\n"
+        "| Name | Roll No |\n|------|---------|\n| Ramesh Kumar | 21CS045 |\n| Priya Nair | 21CS046 |",
+        f"{letterhead}\n\nDear\tLakshmi  Iyer,\n\nYour request dated 14/03/2024 is approved.",
+    ]
+    for processed in preprocess_documents(docs):
+        print(processed.to_stats())
+        print(processed.text)
+        print("restored:", [processed.restore_reference(r) for r in ("Ramesh Kumar", "Lakshmi Iyer")])
+        print("---")
@@ -0,0 +1,30 @@
+-- Migration: Create llm_usage_ledger table (one row per LLM call)
+-- Run this SQL in your Supabase SQL editor
+
+CREATE TABLE IF NOT EXISTS llm_usage_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id UUID REFERENCES auth.users(id) ON DELETE CASCADE,
+    provider TEXT,
+    model TEXT,
+    endpoint TEXT NOT NULL,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    latency_ms REAL,
+    cache_status TEXT NOT NULL DEFAULT 'miss',
+    token_source TEXT,
+    status TEXT NOT NULL DEFAULT 'ok',
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Add comment for documentation
+COMMENT ON TABLE llm_usage_ledger IS 'Per-call LLM usage: tokens, latency and cache status, written in batches by the backend';
+
+-- Rows are inserted by the backend (service key); users can only read their own
+ALTER TABLE llm_usage_ledger ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can read their own LLM usage"
+ON llm_usage_ledger FOR SELECT
+USING (auth.uid() = user_id);
+
+-- Usage queries filter by user and time range
+CREATE INDEX idx_llm_usage_ledger_user_created ON llm_usage_ledger (user_id, created_at DESC);
@@ -1,4 +1,6 @@
 import os
+from bisect import bisect_right
+from itertools import chain
 from typing import Any, Dict, List, Tuple
 from io import BytesIO
 
@@ -6,79 +8,181 @@ from docx import Document
 from docx.document import Document as _Document
 from docx.table import Table
 from docx.text.paragraph import Paragraph
+from docx.text.run import Run
 from docx.oxml.ns import qn
 
+from text_matcher import MultiPatternMatcher, select_non_overlapping
 
-def _replace_across_runs_preserve_style(
-    para: Paragraph,
-    old_value: str,
-    new_value: str,
-    match_case: bool = True,
-) -> int:
-    if not para.runs or not old_value:
-        return 0
 
-    def normalize(s: str) -> str:
-        return s if match_case else s.lower()
+# (start, end, new_text) over a paragraph's joined run text
+Span = Tuple[int, int, str]
 
-    run_texts = [r.text or "" for r in para.runs]
+
+def _rewrite_runs(runs: List[Run], run_texts: List[str], spans: List[Span]) -> None:
+    """
+    Apply sorted, non-overlapping spans to a paragraph's runs in one pass.
+    Text outside the spans stays in the run it was in (keeping its style);
+    a span's new text goes into the run where the span starts.
+    """
     combined = "".join(run_texts)
-    combined_norm = normalize(combined)
-    old_norm = normalize(old_value)
+    run_starts: List[int] = []
+    offset = 0
+    for text in run_texts:
+        run_starts.append(offset)
+        offset += len(text)
+    pieces: List[List[str]] = [[] for _ in runs]
+
+    def copy(start: int, stop: int) -> None:
+        if start >= stop:
+            return
+        run_idx = bisect_right(run_starts, start) - 1
+        while run_idx < len(runs) and run_starts[run_idx] < stop:
+            run_end = run_starts[run_idx] + len(run_texts[run_idx])
+            pieces[run_idx].append(combined[max(start, run_starts[run_idx]):min(stop, run_end)])
+            run_idx += 1
+
+    cursor = 0
+    for start, end, new_text in spans:
+        copy(cursor, start)
+        pieces[bisect_right(run_starts, start) - 1].append(new_text)
+        cursor = end
+    copy(cursor, len(combined))
+
+    for run, old_text, new_pieces in zip(runs, run_texts, pieces):
+        new_text = "".join(new_pieces)
+        if new_text != old_text:
+            run.text = new_text
+
+
+def _match_spans(
+    text: str,
+    matcher: MultiPatternMatcher,
+    new_values: Dict[str, str],
+    match_case: bool,
+) -> List[Span]:
+    """Leftmost-longest replacement spans in one paragraph text."""
+    return [
+        (start, end, new_values[pattern])
+        for start, end, pattern in matcher.find_non_overlapping(_normalize(text, match_case))
+    ]
 
-    if old_norm not in combined_norm:
-        return 0
 
+def _normalize(text: str, match_case: bool) -> str:
     if match_case:
-        occurrences = combined.count(old_value)
-        if occurrences == 0:
-            return 0
-        replaced = combined.replace(old_value, new_value)
-    else:
-        lower_text = combined_norm
-        lower_old = old_norm
-        start = 0
-        pieces: List[str] = []
-        occurrences = 0
-        while True:
-            idx = lower_text.find(lower_old, start)
-            if idx == -1:
-                pieces.append(combined[start:])
-                break
-            pieces.append(combined[start:idx])
-            pieces.append(new_value)
-            start = idx + len(lower_old)
-            occurrences += 1
-        if occurrences == 0:
-            return 0
-        replaced = "".join(pieces)
+        return text
+    lowered = text.lower()
+    # offsets must line up with the original text; keep it case-sensitive otherwise
+    return lowered if len(lowered) == len(text) else text
 
-    remaining = replaced
-    for r in para.runs:
-        if not remaining:
-            r.text = ""
-            continue
-        orig_len = len(r.text or "")
-        r.text = remaining[:orig_len]
-        remaining = remaining[orig_len:]
 
-    if remaining:
-        para.runs[-1].text = (para.runs[-1].text or "") + remaining
+def _compile_replacements(
+    replacements: List[Tuple[str, str]], match_case: bool
+) -> Tuple[MultiPatternMatcher, Dict[str, str]]:
+    """One matcher over all old values; the first pair wins for a repeated old value."""
+    new_values: Dict[str, str] = {}
+    for old_value, new_value in replacements:
+        if old_value:
+            new_values.setdefault(old_value if match_case else old_value.lower(), new_value)
+    return MultiPatternMatcher(new_values), new_values
 
-    return occurrences
+
+def _replace_across_runs_preserve_style(
+    para: Paragraph,
+    old_value: str,
+    new_value: str,
+    match_case: bool = True,
+) -> int:
+    if not old_value:
+        return 0
+    runs = para.runs
+    if not runs:
+        return 0
+    run_texts = [r.text or "" for r in runs]
+    matcher, new_values = _compile_replacements([(old_value, new_value)], match_case)
+    spans = _match_spans("".join(run_texts), matcher, new_values, match_case)
+    if spans:
+        _rewrite_runs(runs, run_texts, spans)
+    return len(spans)
 
 
 def _iter_textbox_paragraphs(document: _Document):
-    body = document.element.body
-    txbx_tag = qn("w:txbxContent")
+    # Both copies of a text box saved with a VML fallback are replaced, so
+    # every Word version shows the new text
     p_tag = qn("w:p")
+    for txbx in document.element.body.iter(qn("w:txbxContent")):
+        for p in txbx.iter(p_tag):
+            yield Paragraph(p, document)
+
+
+class ParagraphTextIndex:
+    """
+    Runs and run texts of every body and text-box paragraph, read once, plus
+    all paragraph texts joined by "\n" so one matcher scan covers the document.
+    """
 
-    for txbx in body.iter():
-        if txbx.tag != txbx_tag:
-            continue
-        for p in txbx.iter():
-            if p.tag == p_tag:
-                yield Paragraph(p, document)
+    def __init__(self, document: _Document):
+        self.paragraphs: List[Paragraph] = []
+        self.runs: List[List[Run]] = []
+        self.run_texts: List[List[str]] = []
+        self.offsets: List[int] = []
+        texts: List[str] = []
+        offset = 0
+        for para in chain(document.paragraphs, _iter_textbox_paragraphs(document)):
+            runs = para.runs
+            run_texts = [r.text or "" for r in runs]
+            text = "".join(run_texts)
+            self.paragraphs.append(para)
+            self.runs.append(runs)
+            self.run_texts.append(run_texts)
+            self.offsets.append(offset)
+            texts.append(text)
+            offset += len(text) + 1
+        self.texts = texts
+        self.text = "\n".join(texts)
+
+    def replace(self, replacements: List[Tuple[str, str]], match_case: bool = True) -> int:
+        """
+        Apply all replacements in a single scan: leftmost-longest,
+        non-overlapping, never across paragraphs. Only paragraphs with a
+        match have their runs rewritten, once each. Returns the match count.
+        """
+        matcher, new_values = _compile_replacements(replacements, match_case)
+        if not matcher:
+            return 0
+        if match_case:
+            text = self.text
+        else:
+            text = "\n".join(_normalize(t, match_case) for t in self.texts)
+
+        by_paragraph: Dict[int, List[Tuple[int, str]]] = {}
+        for start, pattern in matcher.iter_matches(text):
+            para_idx = bisect_right(self.offsets, start) - 1
+            local_start = start - self.offsets[para_idx]
+            if local_start + len(pattern) <= len(self.texts[para_idx]):
+                by_paragraph.setdefault(para_idx, []).append((local_start, pattern))
+
+        total = 0
+        for para_idx, matches in by_paragraph.items():
+            spans = [
+                (start, end, new_values[pattern])
+                for start, end, pattern in select_non_overlapping(matches)
+            ]
+            _rewrite_runs(self.runs[para_idx], self.run_texts[para_idx], spans)
+            total += len(spans)
+        return total
+
+
+def apply_replacements_to_document(
+    doc: _Document,
+    replacements: List[Tuple[str, str]],
+    match_case: bool = True,
+) -> int:
+    """
+    Replace text in body paragraphs and text boxes of an open document
+    (tables are left to table edits). All pairs are matched together, so a
+    replacement's output is never matched again by a later pair.
+    """
+    return ParagraphTextIndex(doc).replace(replacements, match_case)
 
 
 def _apply_single_table_edit(
@@ -148,45 +252,21 @@ def _apply_single_table_edit(
     return changed
 
 
-def replace_text_in_document_bytes(
-    file_bytes: bytes,
-    replacements: List[Tuple[str, str]],
-    table_edits: List[Dict[str, Any]] = None,
+def apply_table_edits(
+    doc: _Document,
+    table_edits: List[Dict[str, Any]] | None,
     match_case: bool = True,
     filename: str | None = None,
-) -> Tuple[BytesIO, int]:
+) -> int:
     """
-    Replace text in one DOCX file (from bytes) in-memory.
-
-    - table_edits: list of dicts like:
-        {
-          "file": "3.Brouche -springboot-a.docx",  # or suffix
-          "table_index": 0,
-          "row": 1,
-          "col": 1,
-          "old_value": "Introduction to spring boot",  # optional
-          "new_value": "Introduction to Langchain"
-        }
-      Only edits whose 'file' matches this document are applied.
-      These edits affect ONLY tables.
-
-    - replacements: (old_value, new_value) applied to:
-        - main body paragraphs
-        - text boxes / shapes
-      (tables are skipped; only table_edits affect them)
-
-    - filename: optional, used to filter table_edits by file.
-
-    Returns: (output_stream, total_replacements_count)
+    Apply table edits (see replace_text_in_document_bytes) to an open
+    document; edits naming another file are skipped. Returns edits applied.
     """
-    input_stream = BytesIO(file_bytes)
-    doc = Document(input_stream)
-
     total_file_replacements = 0
     basename = os.path.basename(filename) if filename else None
 
-    # 1) Apply precise table edits for this file only
     if table_edits:
+        tables = doc.tables  # rebuilt on every access
         for edit in table_edits:
             try:
                 target_file = edit.get("file")
@@ -200,8 +280,8 @@ def replace_text_in_document_bytes(
                 new_value = edit.get("new_value", "")
                 old_value = edit.get("old_value")  # may be None
 
-                if 0 <= table_idx < len(doc.tables):
-                    table = doc.tables[table_idx]
+                if 0 <= table_idx < len(tables):
+                    table = tables[table_idx]
                     applied = _apply_single_table_edit(
                         table=table,
                         row_idx=row_idx,
@@ -216,22 +296,50 @@ def replace_text_in_document_bytes(
                 print(f"Error applying table edit for file '{basename}': {e}")
                 continue
 
-    # 2) Apply normal text replacements to non-table content
-    for old_value, new_value in replacements:
-        if not old_value:
-            continue
+    return total_file_replacements
 
-        # main-story paragraphs
-        for para in doc.paragraphs:
-            total_file_replacements += _replace_across_runs_preserve_style(
-                para, old_value, new_value, match_case
-            )
 
-        # text boxes / shapes
-        for tb_para in _iter_textbox_paragraphs(doc):
-            total_file_replacements += _replace_across_runs_preserve_style(
-                tb_para, old_value, new_value, match_case
-            )
+def replace_text_in_document_bytes(
+    file_bytes: bytes,
+    replacements: List[Tuple[str, str]],
+    table_edits: List[Dict[str, Any]] = None,
+    match_case: bool = True,
+    filename: str | None = None,
+) -> Tuple[BytesIO, int]:
+    """
+    Replace text in one DOCX file (from bytes) in-memory.
+
+    - table_edits: list of dicts like:
+        {
+          "file": "3.Brouche -springboot-a.docx",  # or suffix
+          "table_index": 0,
+          "row": 1,
+          "col": 1,
+          "old_value": "Introduction to spring boot",  # optional
+          "new_value": "Introduction to Langchain"
+        }
+      Only edits whose 'file' matches this document are applied.
+      These edits affect ONLY tables.
+
+    - replacements: (old_value, new_value) applied to:
+        - main body paragraphs
+        - text boxes / shapes
+      (tables are skipped; only table_edits affect them)
+      All pairs are applied in one pass, longest match first, without
+      overlaps (see apply_replacements_to_document).
+
+    - filename: optional, used to filter table_edits by file.
+
+    Returns: (output_stream, total_replacements_count)
+    """
+    input_stream = BytesIO(file_bytes)
+    doc = Document(input_stream)
+
+    # 1) Apply precise table edits for this file only
+    total_file_replacements = apply_table_edits(doc, table_edits, match_case, filename)
+
+    # 2) Apply normal text replacements to non-table content, in one pass
+    total_file_replacements += apply_replacements_to_document(doc, replacements, match_case)
 
     output_stream = BytesIO()
     doc.save(output_stream)
@@ -5,6 +5,7 @@ from typing import Dict, Any, List, TypedDict, Optional, Literal
 from langchain_core.messages import SystemMessage, HumanMessage
 from langgraph.graph import StateGraph, START, END
 from byok_providers import get_provider_adapter
+from hedged_llm import LLMCandidate, hedge_llm
 from pydantic import BaseModel, Field, create_model
 
 # Configure logging
@@ -93,6 +94,8 @@ class ReportState(TypedDict):
     unresolved_columns: List[str]
     llm_provider: str
     api_key: str
+    # the user's other providers, raced against llm_provider (see hedged_llm)
+    hedge_fallbacks: Optional[List[LLMCandidate]]
 
 # ------------------------------------------------------------------------------
 # NODES
@@ -115,6 +118,9 @@ def inference_node(state: ReportState) -> Dict[str, Any]:
     try:
         adapter = get_provider_adapter(provider_name)
         llm = adapter.create_llm(api_key=api_key, temperature=0) # Low temp for deterministic extraction
+        # the adapter's default model, so the ledger can name it
+        model_name = getattr(llm, "model_name", None) or getattr(llm, "model", None)
+        llm = hedge_llm(LLMCandidate(provider_name, model_name, llm), state.get("hedge_fallbacks") or [])
         
         columns = state["columns"]
         context = state["distilled_context"]
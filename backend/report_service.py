@@ -10,6 +10,9 @@ from storage_service import get_user_supabase_client, BUCKET_NAME
 from report_agent import report_agent
 from excel_generator import generate_report_excel
 from byok_encryption import byok_crypto
+from llm_ledger import LedgerCallbackHandler
+from byok_service import key_broker
+from hedged_llm import HEDGING_ENABLED
 
 logger = logging.getLogger(__name__)
 
@@ -91,7 +94,8 @@ def generate_report_preview(
     columns: List[Dict[str, Any]], 
     jwt_token: str,
     llm_api_key: str,
-    llm_provider: str = 'openai'
+    llm_provider: str = 'openai',
+    user_id: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Generates report data.
@@ -111,6 +115,12 @@ def generate_report_preview(
     
     supabase = get_user_supabase_client(jwt_token)
 
+    # Loaded once per report, not per event
+    hedge_fallbacks = (
+        key_broker.get_fallback_llms(user_id, llm_provider, jwt_token, temperature=0)
+        if HEDGING_ENABLED and user_id else []
+    )
+
     for idx, event in enumerate(events):
         event_id = event['id']
         event_name = event.get('name', 'Unknown Event')
@@ -131,11 +141,15 @@ def generate_report_preview(
             "columns": llm_columns,
             "event_schema": schema,
             "llm_provider": llm_provider,
-            "api_key": llm_api_key
+            "api_key": llm_api_key,
+            "hedge_fallbacks": hedge_fallbacks,
         }
         
         try:
-            result = report_agent.invoke(inputs)
+            result = report_agent.invoke(
+                inputs,
+                config={"callbacks": [LedgerCallbackHandler(user_id, "report_inference", provider=llm_provider)]},
+            )
             inferred = result.get("inferred_data", {})
             unresolved_cols = result.get("unresolved_columns", [])
             
@@ -277,8 +291,12 @@ def resolve_event_with_docs(
             llm = adapter.create_llm(api_key=api_key, model=model, temperature=0)
         else:
             llm = adapter.create_llm(api_key=api_key, temperature=0)
+        llm = key_broker.with_hedging(llm, user_id, provider, model, jwt_token, temperature=0)
         
         combined_content = "\n\n---\n\n".join(docs_content)
+        ledger_config = {
+            "callbacks": [LedgerCallbackHandler(user_id, "report_resolve", provider=provider, model=model)]
+        }
 
         # Prefer model-enforced structured output so keys match the configured column names.
         # We still include a plain prompt for extraction quality; the schema enforces the shape.
@@ -327,7 +345,7 @@ def resolve_event_with_docs(
 
         try:
             structured_llm = llm.with_structured_output(DynamicOut)
-            result_obj = structured_llm.invoke(prompt)
+            result_obj = structured_llm.invoke(prompt, config=ledger_config)
             data_by_alias = result_obj.model_dump(by_alias=True)
             return {col: data_by_alias.get(col) for col in missing_columns}
         except Exception as e:
@@ -335,7 +353,7 @@ def resolve_event_with_docs(
             logger.warning(f"Structured output failed, falling back to JSON parsing: {e}")
 
             messages = [HumanMessage(content=prompt)]
-            response = llm.invoke(messages)
+            response = llm.invoke(messages, config=ledger_config)
             content = (response.content or "").strip()
 
             import json
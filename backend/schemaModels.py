@@ -9,6 +9,19 @@ class DocumentIn(BaseModel):
 class SchemaDiscoveryRequest(BaseModel):
     documents: List[DocumentIn]
     user_instructions: Optional[str] = None
+    # seconds; missing documents are reported as pending (default DISCOVERY_LATENCY_BUDGET_SECONDS)
+    latency_budget_seconds: Optional[float] = None
+
+class MailMergeRow(BaseModel):
+    # used for the file name inside the zip
+    name: Optional[str] = None
+    replacements: List[List[str]] = []
+    # same shape as /replace-text table edits (old_value optional)
+    table_edits: List[Dict[str, Any]] = []
+
+class MailMergeRequest(BaseModel):
+    rows: List[MailMergeRow]
+    match_case: bool = True
 
 class TableEdit(BaseModel):
     table_index: int
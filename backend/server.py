@@ -1,30 +1,47 @@
 import json,uuid
+import copy
+import asyncio
 import re
 from datetime import datetime
 import os
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Header, BackgroundTasks
 from typing import List, Dict, Any, Optional
-from fastapi.responses import StreamingResponse, Response
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from extract import docx_bytes_to_markdown_for_preview
 from replace import replace_text_in_document_bytes
+from mail_merge import MAIL_MERGE_MAX_ROWS, TemplateRenderer, stream_mail_merge_zip, zip_content_disposition
 from storage_service import (
     get_events, save_event, delete_event,
     get_docs, delete_all_event_docs, download_doc, update_doc_template, delete_doc,
     get_user_supabase_client, sanitize_filename, BUCKET_NAME, extract_and_store_markdown_from_path
 )
-from schemaModels import SchemaDiscoveryRequest
-from schemaAgent import  schema_discovery_workflow, INITIAL_STATS
+from schemaModels import SchemaDiscoveryRequest, MailMergeRequest
+from schemaAgent import (
+    schema_discovery_workflow, INITIAL_STATS, MODEL_ROUTES, RUNTIME_CONFIG_KEYS,
+    warm_up_tokenizer, compute_discovery_cache_key, get_resumable_workflow, discovery_deadline,
+    MAP_ROUTE,
+)
+from discovery_checkpoint import document_partials, record_run_activity
+from discovery_jobs import DiscoveryJobManager, JobQueueFull
 from byok_endpoints import byok_router
 from byok_service import key_broker
+from hedged_llm import HedgedLLM, hedge_stats
 from byod_endpoints import byod_router
 from report_service import (
     get_report_columns, update_report_columns, 
     generate_report_preview, resolve_event_with_docs, finalize_report_excel
 )
 from chat_agent import build_agent_for_user, stream_agent_response
+from cache_service import schema_cache
+from template_fingerprint import template_store
+from table_schema import table_schema_from_docx_path
+from llm_ledger import (
+    llm_ledger, estimate_cost, query_llm_usage, summarize_llm_usage, LedgerCallbackHandler,
+    abandoned_call_recorder,
+)
 
 # Set up the FastAPI app and add routes
 app = FastAPI(
@@ -121,6 +138,51 @@ async def replace_text(
         print(f"Error in replace_text: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/docs/{doc_id}/mail-merge")
+async def mail_merge(
+    doc_id: str,
+    req: MailMergeRequest,
+    token: Optional[str] = Depends(get_jwt_token)
+):
+    """
+    One template, many rows: the template is downloaded and parsed once and
+    every row is rendered from it. Streams a zip of the documents; its
+    manifest.json lists per-row replacement counts and errors.
+    """
+    if not req.rows:
+        raise HTTPException(status_code=400, detail="No rows provided")
+    if len(req.rows) > MAIL_MERGE_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {MAIL_MERGE_MAX_ROWS} rows per mail merge")
+    for i, row in enumerate(req.rows):
+        if any(len(pair) != 2 for pair in row.replacements):
+            raise HTTPException(status_code=422, detail=f"Row {i}: replacements must be [old, new] pairs")
+
+    try:
+        supabase = get_user_supabase_client(token)
+        doc_result = supabase.table('templates').select('name').eq('id', doc_id).execute()
+        filename = doc_result.data[0]['name'] if doc_result.data else None
+        file_bytes = await asyncio.to_thread(download_doc, doc_id, token)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error loading template: {str(e)}")
+
+    # Parsed before the response starts: once the zip headers are sent, a bad
+    # template could only end in a truncated download
+    try:
+        renderer = await asyncio.to_thread(TemplateRenderer, file_bytes, filename)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Template is not a valid DOCX: {str(e)}")
+
+    rows = [row.model_dump() for row in req.rows]
+    print(f"📨 MAIL MERGE: {len(rows)} rows from template {filename or doc_id}")
+    return StreamingResponse(
+        stream_mail_merge_zip(file_bytes, rows, filename, req.match_case, renderer),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": zip_content_disposition(filename),
+            "X-Total-Rows": str(len(rows)),
+        }
+    )
+
 # Pydantic models
 class Event(BaseModel):
     id: str
@@ -133,6 +195,22 @@ class Variable(BaseModel):
     variableName: str
     originalText: str
 
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness probe: loads the tokenizer so the first discovery request doesn't pay for it."""
+    try:
+        tokenizer = await asyncio.to_thread(warm_up_tokenizer)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Tokenizer not ready: {str(e)}")
+    return {"status": "ready", "tokenizer": tokenizer}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Schema cache hit/miss/eviction counters, which tier is serving, and template reuse."""
+    return {**schema_cache.stats(), "templates": template_store.stats()}
+
+
 # Storage endpoints
 @app.get("/events")
 async def list_events(token: Optional[str] = Depends(get_jwt_token)):
@@ -396,11 +474,50 @@ async def manual_extract(doc_id: str, token: Optional[str] = Depends(get_jwt_tok
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/discover-schema")
-async def discover_schema(req: SchemaDiscoveryRequest, token: Optional[str] = Depends(get_jwt_token)):
-    if not req.documents:
-        raise HTTPException(status_code=400, detail="No documents provided")
-    
+# Optional per-node models for discovery, e.g.
+# {"map": {"provider": "groq", "model": "llama-3.1-8b-instant"},
+#  "consolidate": {"provider": "groq", "model": "llama-3.3-70b-versatile"}}
+try:
+    SCHEMA_MODEL_ROUTES: Dict[str, Dict[str, str]] = json.loads(os.getenv("SCHEMA_MODEL_ROUTES") or "{}")
+except ValueError:
+    print("⚠️ Ignoring invalid SCHEMA_MODEL_ROUTES (not JSON)")
+    SCHEMA_MODEL_ROUTES = {}
+
+
+def _resolve_model_routes(
+    user_id: Optional[str], token: Optional[str], provider: str, model: str
+) -> Dict[str, Dict[str, Any]]:
+    """
+    One LLM per configured route, through the user's BYOK keys. A route whose
+    key is missing (or that names the primary model) is left out, so the
+    workflow falls back to the primary LLM for it.
+    """
+    routes: Dict[str, Dict[str, Any]] = {}
+    for route, target in SCHEMA_MODEL_ROUTES.items():
+        if route not in MODEL_ROUTES or not isinstance(target, dict):
+            continue
+        route_provider = target.get("provider") or provider
+        route_model = target.get("model") or model
+        if (route_provider, route_model) == (provider, model):
+            continue
+        try:
+            route_llm, _ = key_broker.get_llm_for_user(
+                user_id=user_id or "anonymous",
+                provider=route_provider,
+                model=route_model,
+                jwt_token=token,
+                strict_byok=True,
+                temperature=0,
+            )
+        except Exception as e:
+            print(f"⚠️ Route '{route}' ({route_provider}/{route_model}) unavailable, using {provider}/{model}: {e}")
+            continue
+        routes[route] = {"llm_instance": route_llm, "provider": route_provider, "model": route_model}
+    return routes
+
+
+def _get_discovery_llm(token: Optional[str]) -> Dict[str, Any]:
+    """Resolve the user and their BYOK LLM for schema discovery (raises HTTPException)."""
     # Get user ID for BYOK
     user_id = None
     if token:
@@ -410,13 +527,15 @@ async def discover_schema(req: SchemaDiscoveryRequest, token: Optional[str] = De
             user_id = user.user.id
         except Exception:
             pass
-    
+
     # Get LLM instance using BYOK with strict enforcement
+    provider = "groq"  # Default to Groq
+    model = "llama-3.3-70b-versatile"
     try:
         llm_instance, key_metadata = key_broker.get_llm_for_user(
             user_id=user_id or "anonymous",
-            provider="groq",  # Default to Groq
-            model="llama-3.3-70b-versatile",
+            provider=provider,
+            model=model,
             jwt_token=token,
             strict_byok=True,  # Enforce BYOK
             temperature=0
@@ -446,39 +565,80 @@ async def discover_schema(req: SchemaDiscoveryRequest, token: Optional[str] = De
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to initialize LLM: {str(e)}")
 
-    doc_tuples = [(doc.filename, doc.markdown) for doc in req.documents]
-    doc_paths = [doc.docx_path for doc in req.documents if doc.docx_path]
+    routes = _resolve_model_routes(user_id, token, provider, model)
+    # Map calls are idempotent: race them against the user's other providers (LLM_HEDGING_ENABLED)
+    map_entry = routes.get(MAP_ROUTE) or {"llm_instance": llm_instance, "provider": provider, "model": model}
+    hedged_map_llm = key_broker.with_hedging(
+        map_entry["llm_instance"], user_id, map_entry["provider"], map_entry["model"], token,
+        on_abandoned=abandoned_call_recorder(user_id, "schema_map"),
+        temperature=0,
+    )
+    if isinstance(hedged_map_llm, HedgedLLM):
+        routes[MAP_ROUTE] = {**map_entry, "llm_instance": hedged_map_llm}
+        key_metadata = {**key_metadata, "hedging": [c.label for c in hedged_map_llm.candidates]}
+    return {
+        "user_id": user_id,
+        "provider": provider,
+        "model": model,
+        "llm_instance": llm_instance,
+        "routes": routes,
+        "key_metadata": {
+            **key_metadata,
+            "routes": {route: f"{r['provider']}/{r['model']}" for route, r in routes.items()},
+        },
+    }
+
 
-    # Extract table data from documents
+def _extract_tables(documents: List[tuple]) -> List[Dict[str, Any]]:
+    # Table data plus LLM-free table fields, cached per file content
     tables_data = []
-    for doc in req.documents:
-        if doc.docx_path and os.path.exists(doc.docx_path):
+    for filename, docx_path in documents:
+        if docx_path and os.path.exists(docx_path):
             try:
-                with open(doc.docx_path, 'rb') as f:
-                    file_bytes = f.read()
-                from extract_tables import extract_tables_from_docx_bytes
-                doc_tables = extract_tables_from_docx_bytes(file_bytes)
-                if doc_tables:
+                table_schema = table_schema_from_docx_path(docx_path)
+                if table_schema["tables"]:
                     tables_data.append({
-                        "filename": doc.filename,
-                        "tables": doc_tables,
+                        "filename": filename,
+                        "tables": table_schema["tables"],
+                        "fields": {
+                            key: {**field, "cells": [{"file": filename, **cell} for cell in field["cells"]]}
+                            for key, field in table_schema["fields"].items()
+                        },
                     })
             except Exception as e:
-                print(f"Error extracting tables from {doc.filename}: {e}")
+                print(f"Error extracting tables from {filename}: {e}")
+    return tables_data
+
+
+def _extract_request_tables(req: SchemaDiscoveryRequest) -> List[Dict[str, Any]]:
+    return _extract_tables([(doc.filename, doc.docx_path) for doc in req.documents])
+
+
+def _build_discovery_state(
+    req: SchemaDiscoveryRequest, discovery_llm: Dict[str, Any], token: Optional[str]
+) -> Dict[str, Any]:
+    doc_tuples = [(doc.filename, doc.markdown) for doc in req.documents]
+    doc_paths = [doc.docx_path for doc in req.documents if doc.docx_path]
 
     # Pass LLM instance and user context to workflow
-    result = schema_discovery_workflow.invoke(
-        {
-            "documents": doc_tuples,
-            "doc_paths": doc_paths,
-            "stats": INITIAL_STATS.copy(),
-            "user_instructions": req.user_instructions,
-            "user_id": user_id,
-            "jwt_token": token,
-            "llm_instance": llm_instance,
-        }
-    )
+    return {
+        "documents": doc_tuples,
+        "doc_paths": doc_paths,
+        "stats": copy.deepcopy(INITIAL_STATS),
+        "user_instructions": req.user_instructions,
+        "user_id": discovery_llm["user_id"],
+        "jwt_token": token,
+        "llm_instance": discovery_llm["llm_instance"],
+        "llm_provider": discovery_llm["provider"],
+        "llm_model": discovery_llm["model"],
+        "llm_routes": discovery_llm["routes"],
+        "deadline": discovery_deadline(req.latency_budget_seconds),
+    }
+
 
+def _build_discovery_response(
+    result: Dict[str, Any], tables_data: List[Dict[str, Any]], key_metadata: Dict[str, Any]
+) -> Dict[str, Any]:
     stats = result.get("stats", INITIAL_STATS)
 
     # Add key source info to response
@@ -489,21 +649,347 @@ async def discover_schema(req: SchemaDiscoveryRequest, token: Optional[str] = De
         "key_info": key_metadata,
         "message": "✅ Cache hit!" if stats.get("cache_hit") else
         f"✅ Generated from {stats.get('docs_processed', 0)} docs",
+        # documents missing from the schema; pending ones are filled by running again
+        "partial": bool(stats.get("pending_documents")),
+        "pending_documents": stats.get("pending_documents", []),
+        "skipped_documents": stats.get("skipped_documents", []),
     }
-    
-
+    if response["partial"]:
+        response["message"] = (
+            f"⏳ Partial result from {stats.get('docs_processed', 0)} docs: "
+            f"{len(stats['pending_documents'])} still being mapped, run again to add them"
+        )
 
     llm_summary = stats.get("llm", {}).get("summary", {})
     if llm_summary.get("llm_calls", 0) > 0:
+        route_stats = stats.get("routes") or {}
+        if route_stats:
+            # each route is priced with the model that served it
+            by_route = {
+                route: {
+                    "model": r.get("model"),
+                    "tokens": r["input_tokens"] + r["output_tokens"],
+                    **estimate_cost(r.get("model"), r["input_tokens"], r["output_tokens"]),
+                }
+                for route, r in route_stats.items()
+            }
+            cost = {
+                key: round(sum(r[key] for r in by_route.values()), 6)
+                for key in ("input_cost_usd", "output_cost_usd", "total_cost_usd")
+            }
+            cost["priced"] = all(r["priced"] for r in by_route.values())
+            cost["by_route"] = by_route
+        else:
+            cost = estimate_cost(
+                result.get("llm_model"),
+                llm_summary.get("total_input_tokens", 0),
+                llm_summary.get("total_output_tokens", 0),
+            )
         response["estimated_cost"] = {
             "tokens": llm_summary.get("total_tokens", 0),
-            "input_cost_usd": 0.0,   # plug in real pricing if needed
-            "output_cost_usd": 0.0,
-            "total_cost_usd": 0.0,
+            "model": result.get("llm_model"),
+            **cost,
         }
 
     return response
 
+
+# Discovery runs on its own bounded pool; identical in-flight requests share one run
+discovery_jobs = DiscoveryJobManager(
+    schema_discovery_workflow, list(schema_discovery_workflow.builder.nodes)
+)
+
+
+def _submit_discovery_job(req: SchemaDiscoveryRequest, token: Optional[str], require_user: bool = False):
+    if not req.documents:
+        raise HTTPException(status_code=400, detail="No documents provided")
+
+    discovery_llm = _get_discovery_llm(token)
+    if require_user and not discovery_llm["user_id"]:
+        # the job id would be the only thing protecting the extracted content
+        raise HTTPException(status_code=401, detail="Authentication required for discovery jobs")
+    initial_state = _build_discovery_state(req, discovery_llm, token)
+    key = f"{discovery_llm['user_id'] or 'anonymous'}:{compute_discovery_cache_key(initial_state)}"
+    try:
+        return discovery_jobs.submit(
+            key,
+            discovery_llm["user_id"],
+            initial_state,
+            context={
+                "tables": _extract_request_tables(req),
+                "key_metadata": discovery_llm["key_metadata"],
+            },
+        )
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=f"Schema discovery is busy, retry shortly ({str(e)})")
+
+
+def _discovery_job_response(job) -> Dict[str, Any]:
+    return _build_discovery_response(job.result, job.context["tables"], job.context["key_metadata"])
+
+
+@app.post("/discover-schema")
+async def discover_schema(req: SchemaDiscoveryRequest, token: Optional[str] = Depends(get_jwt_token)):
+    job = _submit_discovery_job(req, token)
+    try:
+        await asyncio.wrap_future(job.future)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Schema discovery failed: {str(e)}")
+    return _discovery_job_response(job)
+
+
+@app.post("/discover-schema/jobs", status_code=202)
+async def submit_discovery_job(req: SchemaDiscoveryRequest, token: Optional[str] = Depends(get_jwt_token)):
+    """Queue discovery and return immediately; poll the status/result endpoints (signed-in users only)."""
+    job = _submit_discovery_job(req, token, require_user=True)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "coalesced": job.coalesced > 0,
+    }
+
+
+def _get_discovery_job(job_id: str, token: Optional[str]):
+    if not token:
+        raise HTTPException(status_code=401, detail="Authentication required for discovery jobs")
+    try:
+        user_id = get_user_supabase_client(token).auth.get_user().user.id
+    except Exception:
+        raise HTTPException(status_code=401, detail="Invalid authentication token")
+    job = discovery_jobs.get(job_id, user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/discover-schema/jobs/{job_id}")
+async def discovery_job_status(job_id: str, token: Optional[str] = Depends(get_jwt_token)):
+    """Job status with per-node progress of the discovery graph."""
+    return _get_discovery_job(job_id, token).to_dict()
+
+
+@app.get("/discover-schema/jobs/{job_id}/result")
+async def discovery_job_result(job_id: str, token: Optional[str] = Depends(get_jwt_token)):
+    """Same body as /discover-schema once the job succeeded; 202 with status while it runs."""
+    job = _get_discovery_job(job_id, token)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=f"Schema discovery failed: {job.error}")
+    if not job.done:
+        return JSONResponse(status_code=202, content=job.to_dict())
+    return _discovery_job_response(job)
+
+
+# ------------------------------------------------------------------------------
+# RESUMABLE DISCOVERY RUNS (checkpointed to SQLite, resumable by run id)
+# ------------------------------------------------------------------------------
+
+def _current_user_id(token: Optional[str]) -> Optional[str]:
+    if not token:
+        return None
+    try:
+        return get_user_supabase_client(token).auth.get_user().user.id
+    except Exception:
+        raise HTTPException(status_code=401, detail="Invalid authentication token")
+
+
+async def _execute_discovery_run(
+    run_id: str,
+    input_state: Optional[Dict[str, Any]],
+    discovery_llm: Dict[str, Any],
+    token: Optional[str],
+    tables_data: List[Dict[str, Any]],
+    deadline: Optional[float],
+) -> Dict[str, Any]:
+    """Run (input_state) or resume (None) a checkpointed discovery run."""
+    config = {
+        "configurable": {
+            "thread_id": run_id,
+            "llm_instance": discovery_llm["llm_instance"],
+            "llm_routes": discovery_llm["routes"],
+            "jwt_token": token,
+            "deadline": deadline,
+        }
+    }
+    try:
+        await asyncio.to_thread(record_run_activity, run_id)
+        result = await asyncio.to_thread(
+            get_resumable_workflow().invoke, input_state, config, durability="sync"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "error": "DISCOVERY_RUN_FAILED",
+                "message": str(e),
+                "run_id": run_id,
+                "resume": f"/discover-schema/runs/{run_id}/resume",
+            },
+        )
+    if not (result.get("stats") or {}).get("pending_documents"):
+        # complete: the graph checkpoint has the result, the partials are not needed again
+        await asyncio.to_thread(document_partials.delete_run, run_id)
+    return {"run_id": run_id, **_build_discovery_response(result, tables_data, discovery_llm["key_metadata"])}
+
+
+def _pending_rerun_state(values: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Input that runs a finished run's graph again from the start, for the
+    documents it left pending. Mapped documents come back from the document
+    cache or the run's partials, so only the pending ones are paid for.
+    """
+    return {
+        "documents": values.get("documents") or [],
+        "doc_paths": values.get("doc_paths") or [],
+        "user_instructions": values.get("user_instructions"),
+        "user_id": values.get("user_id"),
+        "llm_provider": values.get("llm_provider"),
+        "llm_model": values.get("llm_model"),
+        "stats": copy.deepcopy(INITIAL_STATS),
+        # outputs of the previous pass
+        "cache_key": None,
+        "partial_schemas": [],
+        "final_schema": None,
+        "consolidation_clusters": None,
+        "shared_blocks": {},
+    }
+
+
+def _get_run_snapshot(run_id: str, user_id: Optional[str]):
+    snapshot = get_resumable_workflow().get_state({"configurable": {"thread_id": run_id}})
+    if not snapshot.values or snapshot.values.get("user_id") != user_id:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return snapshot
+
+
+@app.post("/discover-schema/runs")
+async def start_discovery_run(req: SchemaDiscoveryRequest, token: Optional[str] = Depends(get_jwt_token)):
+    """
+    Checkpointed discovery: the state is saved after every node and each
+    mapped document as it finishes. On failure the 500 detail carries the
+    run_id to resume with.
+    """
+    if not req.documents:
+        raise HTTPException(status_code=400, detail="No documents provided")
+    discovery_llm = _get_discovery_llm(token)
+    initial_state = _build_discovery_state(req, discovery_llm, token)
+    deadline = initial_state.get("deadline")
+    # clients, tokens and the deadline travel in the config; the state gets persisted
+    for key in RUNTIME_CONFIG_KEYS:
+        initial_state.pop(key, None)
+    return await _execute_discovery_run(
+        uuid.uuid4().hex, initial_state, discovery_llm, token, _extract_request_tables(req), deadline
+    )
+
+
+@app.post("/discover-schema/runs/{run_id}/resume")
+async def resume_discovery_run(
+    run_id: str,
+    latency_budget_seconds: Optional[float] = None,
+    token: Optional[str] = Depends(get_jwt_token),
+):
+    """
+    Continue a failed or interrupted run from its last completed node/document,
+    or map the documents a run left pending at its deadline.
+    """
+    discovery_llm = _get_discovery_llm(token)
+    snapshot = _get_run_snapshot(run_id, discovery_llm["user_id"])
+    tables_data = _extract_tables(
+        [(os.path.basename(path), path) for path in snapshot.values.get("doc_paths") or []]
+    )
+    input_state = None
+    if not snapshot.next:
+        pending = (snapshot.values.get("stats") or {}).get("pending_documents")
+        if not pending:
+            # already finished; nothing to pay for again
+            return {"run_id": run_id, **_build_discovery_response(snapshot.values, tables_data, discovery_llm["key_metadata"])}
+        # finished at its deadline: map the documents it left pending
+        print(f"⏯️ RESUMING RUN {run_id[:8]} for {len(pending)} pending document(s)")
+        input_state = _pending_rerun_state(snapshot.values)
+    else:
+        print(f"⏯️ RESUMING RUN {run_id[:8]} at {list(snapshot.next)}")
+    return await _execute_discovery_run(
+        run_id, input_state, discovery_llm, token, tables_data, discovery_deadline(latency_budget_seconds)
+    )
+
+
+@app.get("/discover-schema/runs/{run_id}")
+async def discovery_run_status(run_id: str, token: Optional[str] = Depends(get_jwt_token)):
+    snapshot = _get_run_snapshot(run_id, _current_user_id(token))
+    stats = snapshot.values.get("stats") or {}
+    return {
+        "run_id": run_id,
+        "completed": not snapshot.next,
+        "next_nodes": list(snapshot.next),
+        "nodes_completed": (stats.get("route") or {}).get("path", []),
+        "documents": len(snapshot.values.get("documents") or []),
+        "documents_checkpointed": document_partials.count(run_id),
+        "updated_at": snapshot.created_at,
+    }
+
+
+# Graph node -> SSE event type for the node's state update
+DISCOVERY_NODE_EVENTS = {
+    "merge_schemas": "merged_schema",
+    "consolidate_entities": "consolidated_schema",
+}
+
+
+@app.post("/discover-schema/stream")
+async def discover_schema_stream(req: SchemaDiscoveryRequest, token: Optional[str] = Depends(get_jwt_token)):
+    """
+    Streaming variant of /discover-schema (Server-Sent Events):
+      partial_schema (one per document, as it finishes) -> merged_schema ->
+      consolidated_schema -> locations (batches of fields) -> done
+    The final `done` event carries the same body /discover-schema returns.
+    """
+    if not req.documents:
+        raise HTTPException(status_code=400, detail="No documents provided")
+
+    discovery_llm = _get_discovery_llm(token)
+    tables_data = _extract_request_tables(req)
+    initial_state = _build_discovery_state(req, discovery_llm, token)
+
+    async def event_stream():
+        yield _sse_data({"type": "meta", "documents": len(req.documents), "key_info": discovery_llm["key_metadata"]})
+        if tables_data:
+            yield _sse_data({"type": "tables", "tables": tables_data})
+
+        result: Dict[str, Any] = dict(initial_state)
+        try:
+            async for mode, chunk in schema_discovery_workflow.astream(
+                initial_state, stream_mode=["updates", "custom"]
+            ):
+                if mode == "custom":
+                    yield _sse_data(chunk)
+                    continue
+
+                for node_name, update in (chunk or {}).items():
+                    if not update:
+                        continue
+                    result.update(update)
+                    event_type = DISCOVERY_NODE_EVENTS.get(node_name)
+                    if event_type and update.get("final_schema") is not None:
+                        yield _sse_data({"type": event_type, "schema": update["final_schema"]})
+
+            yield _sse_data(
+                {
+                    "type": "done",
+                    **_build_discovery_response(result, tables_data, discovery_llm["key_metadata"]),
+                }
+            )
+        except Exception as e:
+            yield _sse_data({"type": "error", "message": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
     
 # ------------------------------------------------------------------------------
 # REPORT ENDPOINTS
@@ -663,6 +1149,7 @@ async def chat_stream(req: ChatStreamRequest, token: Optional[str] = Depends(get
                 agent=agent,
                 user_message=message,
                 thread_id=thread_id,
+                callbacks=[LedgerCallbackHandler(user_id=user_id, endpoint="chat")],
             ):
                 yield _sse_data(chunk)
             yield _sse_data({"type": "done", "thread_id": thread_id})
@@ -745,7 +1232,8 @@ async def generate_report(req: ReportGenerateRequest, token: Optional[str] = Dep
             req.columns, 
             token, 
             llm_api_key=api_key,
-            llm_provider=provider
+            llm_provider=provider,
+            user_id=user_id,
         )
         return result
     except Exception as e:
@@ -800,6 +1288,37 @@ async def download_report(req: ReportDownloadRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.get("/usage/llm")
+async def llm_usage_summary(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    token: Optional[str] = Depends(get_jwt_token),
+):
+    """
+    LLM latency (p50/p95) and token spend per user and model from the usage ledger,
+    optionally limited to an ISO date/time range. Costs use LLM_PRICING_JSON overrides.
+    """
+    if not token:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    try:
+        supabase = get_user_supabase_client(token)
+        rows = await asyncio.to_thread(query_llm_usage, supabase, start, end)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load LLM usage: {str(e)}")
+
+    summary = summarize_llm_usage(rows)
+    return {
+        "start": start,
+        "end": end,
+        "records": len(rows),
+        "usage": summary,
+        "total_cost_usd": round(sum(group["cost"]["total_cost_usd"] for group in summary), 6),
+        "ledger": llm_ledger.stats(),
+        "hedging": hedge_stats.snapshot(),
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("server:app", host="127.0.0.1", port=8000, reload=True)
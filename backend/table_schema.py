@@ -0,0 +1,284 @@
+"""
+Table Schema Inference
+Deterministic (LLM-free) table fields from `extract_tables_from_docx_bytes`
+output, addressed by table_index / row / col exactly like `replace.py` table edits.
+
+Two table shapes are recognised:
+  - key/value: two columns, labels on the left ("Venue:", "Date"), values on the right
+  - header tables: a header row (after any full-width title rows); each column
+    becomes a field over the rows below it
+
+Extraction + inference results are cached per DOCX content hash, and the hash
+itself is memoized per (path, mtime, size), so an unchanged file on disk is
+neither re-read nor re-parsed.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache_service import schema_cache
+from extract_tables import extract_tables_from_docx_bytes
+
+TABLE_SCHEMA_VERSION = "tables-v1"
+TABLE_SCHEMA_PREFIX = "tableschema"
+TABLE_SCHEMA_TTL = 7 * 24 * 3600
+MAX_LABEL_CHARS = 60
+MAX_LABEL_WORDS = 8
+# share of cells that must agree for a column type / a label column
+MAJORITY = 0.8
+_HASH_MEMO_SIZE = 1024
+
+_TYPE_PATTERNS: List[Tuple[str, re.Pattern]] = [
+    ("email", re.compile(r"^[\w.+-]+@[\w-]+(\.[\w-]+)+$")),
+    ("url", re.compile(r"^(https?://|www\.)\S+$", re.I)),
+    (
+        "date",
+        re.compile(
+            r"^(\d{1,2}[./-]\d{1,2}[./-]\d{2,4}|\d{4}-\d{1,2}-\d{1,2}"
+            r"|\d{1,2}(st|nd|rd|th)?\s+[A-Za-z]{3,9},?\s+\d{4}|[A-Za-z]{3,9}\s+\d{1,2}(st|nd|rd|th)?,?\s+\d{4})$"
+        ),
+    ),
+    ("time", re.compile(r"^\d{1,2}[:.]\d{2}(\s*[AaPp]\.?[Mm]\.?)?(\s*(-|to)\s*\d{1,2}[:.]\d{2}(\s*[AaPp]\.?[Mm]\.?)?)?$")),
+    ("phone", re.compile(r"^\+?[\d\s()-]{10,}$")),
+    ("currency", re.compile(r"^(₹|Rs\.?|INR|\$|USD|€)\s?\d[\d,]*(\.\d+)?(/-)?$", re.I)),
+    ("number", re.compile(r"^-?\d[\d,]*(\.\d+)?%?$")),
+    ("boolean", re.compile(r"^(yes|no|true|false|y|n)$", re.I)),
+]
+_LETTER_RE = re.compile(r"[^\W\d_]")
+_KEY_RE = re.compile(r"[^a-z0-9]+")
+
+
+def infer_value_type(value: str) -> str:
+    value = (value or "").strip()
+    if not value:
+        return "empty"
+    if "\n" in value:
+        return "list"
+    for type_name, pattern in _TYPE_PATTERNS:
+        if pattern.match(value):
+            return type_name
+    return "text"
+
+
+def _column_type(values: List[str]) -> str:
+    types = [t for t in (infer_value_type(v) for v in values) if t != "empty"]
+    if not types:
+        return "text"
+    type_name, count = Counter(types).most_common(1)[0]
+    return type_name if count >= MAJORITY * len(types) else "text"
+
+
+def _is_label(text: str) -> bool:
+    text = (text or "").strip()
+    return (
+        bool(text)
+        and "\n" not in text
+        and len(text) <= MAX_LABEL_CHARS
+        and len(text.split()) <= MAX_LABEL_WORDS
+        and bool(_LETTER_RE.search(text))
+        and infer_value_type(text) == "text"
+    )
+
+
+def _field_key(label: str) -> str:
+    return _KEY_RE.sub("_", label.lower().rstrip(":")).strip("_") or "column"
+
+
+def _effective_cells(table: Dict[str, Any], row_idx: int) -> List[Tuple[int, str]]:
+    """
+    (col, text) with horizontally merged cells (repeated by python-docx) kept
+    once, at their first column. Tables extracted before `merged` existed fall
+    back to treating adjacent identical texts as one merged cell.
+    """
+    row = table["preview"][row_idx]
+    merged = table.get("merged")
+    if merged and row_idx < len(merged):
+        return [(col, text) for col, text in enumerate(row) if merged[row_idx][col] == col]
+    cells: List[Tuple[int, str]] = []
+    for col, text in enumerate(row):
+        if col and text and row[col - 1] == text:
+            continue
+        cells.append((col, text))
+    return cells
+
+
+def _cell(table: Dict[str, Any], row: int, col: int) -> Dict[str, Any]:
+    """A cell address usable as a replace.py table edit (old_value only when the cell is one paragraph)."""
+    paragraphs = table.get("paragraphs") or []
+    try:
+        paras = paragraphs[row][col]
+    except IndexError:
+        paras = []
+    text = table["preview"][row][col]
+    return {
+        "table_index": table["index"],
+        "row": row,
+        "col": col,
+        "text": text,
+        # multi-paragraph cells: omit old_value so the edit rewrites the cell
+        "old_value": paras[0] if len(paras) == 1 else None,
+    }
+
+
+def _key_value_fields(table: Dict[str, Any], rows: List[List[Tuple[int, str]]]) -> Optional[List[Dict[str, Any]]]:
+    pairs = [(idx, cells) for idx, cells in enumerate(rows) if len(cells) == 2]
+    if len(pairs) < 2 or len(pairs) < MAJORITY * len(rows):
+        return None
+    labels = [cells[0][1] for _, cells in pairs]
+    values = [cells[1][1] for _, cells in pairs]
+    if sum(_is_label(label) for label in labels) < MAJORITY * len(labels):
+        return None
+    if len(set(labels)) != len(labels):
+        return None
+    # A two-column header table ("Name | Roll No" over names and numbers) has
+    # uniform values per column; key/value tables have colon labels, or values
+    # of mixed types, or a first value that does not read like a header.
+    colon_labels = sum(label.rstrip().endswith(":") for label in labels) >= 0.5 * len(labels)
+    value_types = {infer_value_type(v) for v in values} - {"empty"}
+    if not (colon_labels or len(value_types) > 1 or not _is_label(values[0])):
+        return None
+
+    fields = []
+    for row_idx, cells in pairs:
+        (_, label), (value_col, value) = cells
+        if not _is_label(label):
+            continue
+        fields.append(
+            {
+                "label": label.strip().rstrip(":").strip(),
+                "type": infer_value_type(value) if value else "text",
+                "kind": "key_value",
+                "table_index": table["index"],
+                "cells": [_cell(table, row_idx, value_col)],
+            }
+        )
+    return fields
+
+
+def _header_fields(table: Dict[str, Any], rows: List[List[Tuple[int, str]]]) -> Optional[List[Dict[str, Any]]]:
+    n_columns = table.get("columns") or 0
+    header_idx = 0
+    # full-width title rows ("LIST OF PARTICIPANTS") sit above the header
+    while header_idx < len(rows) and n_columns > 1 and len(rows[header_idx]) == 1:
+        header_idx += 1
+    if header_idx >= len(rows) - 1:
+        return None
+    header = rows[header_idx]
+    labels = [text for _, text in header]
+    if len(header) < 2 or not all(labels) or len(set(labels)) != len(labels):
+        return None
+    if sum(_is_label(label) for label in labels) < MAJORITY * len(labels):
+        return None
+
+    data_rows = range(header_idx + 1, len(rows))
+    fields = []
+    for col, label in header:
+        cells = [
+            _cell(table, row_idx, col)
+            for row_idx in data_rows
+            # skip rows where this column is covered by a cell merged from the left
+            if any(c == col for c, _ in rows[row_idx])
+        ]
+        if not cells:
+            continue
+        fields.append(
+            {
+                "label": label.strip(),
+                "type": _column_type([c["text"] for c in cells]),
+                "kind": "column",
+                "table_index": table["index"],
+                "header_row": header_idx,
+                "column": col,
+                "cells": cells,
+            }
+        )
+    return fields
+
+
+def infer_table_fields(tables: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    {field_key: field} for one document's extracted tables. Each field has a
+    label, an inferred type, the kind of table it came from, its cells
+    ({table_index, row, col, text, old_value}) and the distinct non-empty
+    cell texts as references.
+    """
+    fields: Dict[str, Dict[str, Any]] = {}
+    for table in tables:
+        preview = table.get("preview") or []
+        if not preview:
+            continue
+        rows = [_effective_cells(table, row_idx) for row_idx in range(len(preview))]
+        table_fields = _key_value_fields(table, rows) or _header_fields(table, rows) or []
+        for field in table_fields:
+            key = _field_key(field["label"])
+            unique_key, n = key, 2
+            while unique_key in fields:
+                unique_key, n = f"{key}_{n}", n + 1
+            field["references"] = list(dict.fromkeys(c["text"] for c in field["cells"] if c["text"]))
+            fields[unique_key] = field
+    return fields
+
+
+def table_schema_from_docx_bytes(file_bytes: bytes, content_hash: Optional[str] = None) -> Dict[str, Any]:
+    """{"tables": extract_tables output, "fields": infer_table_fields(...)}, cached per content hash."""
+    content_hash = content_hash or hashlib.sha256(file_bytes).hexdigest()
+    cache_key = f"{TABLE_SCHEMA_PREFIX}:{TABLE_SCHEMA_VERSION}:{content_hash}"
+    cached = schema_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    tables = extract_tables_from_docx_bytes(file_bytes)
+    result = {"tables": tables, "fields": infer_table_fields(tables)}
+    schema_cache.set(cache_key, result, TABLE_SCHEMA_TTL)
+    return result
+
+
+_hash_memo: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_hash_memo_lock = threading.Lock()
+
+
+def table_schema_from_docx_path(path: str) -> Dict[str, Any]:
+    """Like table_schema_from_docx_bytes, without reading a file whose hash is already known."""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    with _hash_memo_lock:
+        content_hash = _hash_memo.get(memo_key)
+        if content_hash is not None:
+            _hash_memo.move_to_end(memo_key)
+    if content_hash is not None:
+        cached = schema_cache.get(f"{TABLE_SCHEMA_PREFIX}:{TABLE_SCHEMA_VERSION}:{content_hash}")
+        if cached is not None:
+            return cached
+
+    with open(path, "rb") as f:
+        file_bytes = f.read()
+    content_hash = hashlib.sha256(file_bytes).hexdigest()
+    with _hash_memo_lock:
+        _hash_memo[memo_key] = content_hash
+        while len(_hash_memo) > _HASH_MEMO_SIZE:
+            _hash_memo.popitem(last=False)
+    return table_schema_from_docx_bytes(file_bytes, content_hash)
+
+
+if __name__ == "__main__":
+    import json
+
+    demo_tables = [
+        {
+            "index": 0,
+            "rows": 4,
+            "columns": 2,
+            "preview": [["Event:", "Guest Lecture on Spring Boot"], ["Date:", "12/03/2024"], ["Venue:", "Seminar Hall"], ["Resource Person:", "Dr. Anil Rao"]],
+            "paragraphs": [[["Event:"], ["Guest Lecture on Spring Boot"]], [["Date:"], ["12/03/2024"]], [["Venue:"], ["Seminar Hall"]], [["Resource Person:"], ["Dr. Anil Rao"]]],
+        },
+        {
+            "index": 1,
+            "rows": 4,
+            "columns": 3,
+            "preview": [["LIST OF PARTICIPANTS"] * 3, ["Name", "Roll No", "Attended On"], ["Ramesh Kumar", "21CS045", "12/03/2024"], ["Priya Nair", "21CS046", "12/03/2024"]],
+            "paragraphs": [[["LIST OF PARTICIPANTS"]] * 3, [["Name"], ["Roll No"], ["Attended On"]], [["Ramesh Kumar"], ["21CS045"], ["12/03/2024"]], [["Priya Nair"], ["21CS046"], ["12/03/2024"]]],
+        },
+    ]
+    print(json.dumps(infer_table_fields(demo_tables), indent=2))
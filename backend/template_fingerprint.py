@@ -0,0 +1,400 @@
+"""
+Template fingerprints: reuse a discovered schema across structurally
+identical documents (same letter/certificate template, different names and dates).
+
+When a document is mapped by the LLM, its markdown is turned into a template:
+  - a MinHash signature over word shingles of the text with its references
+    masked (digits normalized), used to find candidate templates for a new
+    document cheaply
+  - the document's lines with every discovered reference masked; lines that
+    contained references become regexes whose capture groups are the fields
+
+A new document whose signature is close enough to a stored template is matched
+line by line: references are read back out of the capture groups (no LLM), and
+only the lines that match no template line ("residual" text) go to the LLM.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from cache_service import SchemaCache, schema_cache
+from text_matcher import MultiPatternMatcher
+
+TEMPLATE_MATCHING_ENABLED = os.getenv("TEMPLATE_MATCHING_ENABLED", "true").lower() in ("1", "true", "yes")
+# Estimated share of a template's literal shingles (its references masked)
+# found in the document, needed to try the template. Containment rather than
+# Jaccard, so a filled-in copy with other names and a few extra lines still
+# scores ~0.9; unrelated documents share few shingles. Only a pre-filter: the
+# line coverage check below is what accepts a match.
+TEMPLATE_MATCH_THRESHOLD = float(os.getenv("TEMPLATE_MATCH_THRESHOLD", "0.5"))
+# Share of the document's non-blank lines the template must explain
+TEMPLATE_MIN_LINE_COVERAGE = float(os.getenv("TEMPLATE_MIN_LINE_COVERAGE", "0.8"))
+# Residual text shorter than this is not worth an LLM call
+TEMPLATE_RESIDUAL_MIN_CHARS = int(os.getenv("TEMPLATE_RESIDUAL_MIN_CHARS", "50"))
+TEMPLATE_MAX_PER_SCOPE = int(os.getenv("TEMPLATE_MAX_PER_SCOPE", "200"))
+TEMPLATE_TTL = int(os.getenv("TEMPLATE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+TEMPLATE_PREFIX = "template"
+SHINGLE_SIZE = 3
+NUM_PERM = 64
+MAX_REFERENCE_CHARS = 300
+# Lines with fewer letters than this outside their variables ("| x | y |")
+# only match when the previous line matches too
+MIN_LITERAL_LETTERS = 4
+
+# Multiply-shift hash family: (a*h + b) mod 2**64 (uint64 wrap-around), top 32 bits
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(0, 1 << 62, size=NUM_PERM, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+_PERM_B = _rng.randint(0, 1 << 62, size=NUM_PERM, dtype=np.int64).astype(np.uint64)
+
+_VAR = "\x00"
+_DIGITS_RE = re.compile(r"\d+")
+_WS_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"\w+")
+_LETTER_RE = re.compile(r"[^\W\d_]")
+
+
+def normalize_line(line: str) -> str:
+    """Whitespace collapsed, digit runs replaced: dates and numbers never break a match."""
+    return _WS_RE.sub(" ", _DIGITS_RE.sub("0", line)).strip()
+
+
+def _line_hash(line: str) -> str:
+    return hashlib.blake2b(line.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _shingles(markdown: str) -> Set[str]:
+    """
+    Word shingles of the digit-normalized text. Shingles never span a masked
+    variable (_VAR): a template keeps only shingles of its literal text, which
+    every filled-in copy of it also contains.
+    """
+    segments = [
+        _WORD_RE.findall(_DIGITS_RE.sub("0", segment))
+        for segment in markdown.lower().split(_VAR)
+    ]
+    shingles = {
+        " ".join(words[i:i + SHINGLE_SIZE])
+        for words in segments
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+    return shingles or {" ".join(word for words in segments for word in words)}
+
+
+def _signature_of(shingles: Set[str]) -> np.ndarray:
+    """NUM_PERM-value MinHash of a shingle set."""
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    with np.errstate(over="ignore"):
+        permuted = (hashes[:, None] * _PERM_A + _PERM_B) >> np.uint64(32)
+    return permuted.min(axis=0)
+
+
+def estimate_containment(jaccard: np.ndarray, template_shingles: np.ndarray, doc_shingles: int) -> np.ndarray:
+    """
+    Share of a template's shingles found in the document, from the MinHash
+    Jaccard estimate and both set sizes: |T & D| = J * (|T| + |D|) / (1 + J).
+    Unlike Jaccard it is not lowered by the document's own names or extra lines.
+    """
+    overlap = jaccard * (template_shingles + doc_shingles) / (1 + jaccard)
+    return np.minimum(overlap / np.maximum(template_shingles, 1), 1.0)
+
+
+def _line_regex(masked_line: str) -> str:
+    """Literal text escaped (digit runs as \\d+), each masked span a lazy capture group."""
+    parts = []
+    for literal_idx, literal in enumerate(masked_line.split(_VAR)):
+        if literal_idx:
+            parts.append("(.+?)")
+        for piece_idx, piece in enumerate(_DIGITS_RE.split(literal)):
+            if piece_idx:
+                parts.append(r"\d+")
+            parts.append(re.escape(piece))
+    return r"\s*" + "".join(parts) + r"\s*"
+
+
+def build_template(markdown: str, partial_schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Template record for a document and the partial schema the LLM found in it,
+    or None when none of its references occur in the markdown.
+    """
+    field_of_reference: Dict[str, str] = {}
+    fields: Dict[str, Dict[str, Any]] = {}
+    for field_key, field_val in partial_schema.items():
+        if not isinstance(field_val, dict):
+            continue
+        fields[field_key] = {
+            k: v for k, v in field_val.items() if k not in ("references", "source_filename")
+        }
+        for ref in field_val.get("references") or []:
+            if isinstance(ref, str) and ref.strip():
+                field_of_reference.setdefault(ref, field_key)
+
+    matcher = MultiPatternMatcher(field_of_reference)
+    if not matcher:
+        return None
+
+    literal_lines: Set[str] = set()
+    masked_lines: List[str] = []
+    patterns: List[Dict[str, Any]] = []
+    seen_patterns: Set[Tuple[str, str]] = set()
+    prev_regex = ""
+    for line in markdown.split("\n"):
+        if not line.strip():
+            continue
+        spans = matcher.find_non_overlapping(line)
+        if not spans:
+            literal_lines.add(_line_hash(normalize_line(line)))
+            masked_lines.append(line)
+            prev_regex = _line_regex(line)
+            continue
+        masked, cursor = [], 0
+        for start, end, _ in spans:
+            masked.append(line[cursor:start])
+            masked.append(_VAR)
+            cursor = end
+        masked.append(line[cursor:])
+        masked_line = "".join(masked)
+        masked_lines.append(masked_line)
+        regex = _line_regex(masked_line)
+        literal_letters = len(_LETTER_RE.findall(masked_line))
+        context = prev_regex if literal_letters < MIN_LITERAL_LETTERS else ""
+        if (regex, context) not in seen_patterns:
+            seen_patterns.add((regex, context))
+            patterns.append(
+                {
+                    "regex": regex,
+                    "prev": context,
+                    "fields": [field_of_reference[pattern] for _, _, pattern in spans],
+                }
+            )
+        prev_regex = regex
+
+    if not patterns:
+        return None
+    literal_shingles = _shingles("\n".join(masked_lines))
+    return {
+        "id": hashlib.sha256("\n".join(p["regex"] for p in patterns).encode("utf-8")).hexdigest()[:16],
+        # references masked: this document's names are not part of the template
+        "signature": _signature_of(literal_shingles).tolist(),
+        "shingles": len(literal_shingles),
+        "fields": fields,
+        "patterns": patterns,
+        "literal_lines": sorted(literal_lines),
+        "created_at": time.time(),
+    }
+
+
+class TemplateMatch:
+    """Result of applying a template to a new document."""
+
+    def __init__(self, template_id: str, similarity: float):
+        self.template_id = template_id
+        self.similarity = similarity
+        self.partial_schema: Dict[str, Any] = {}
+        self.residual_lines: List[str] = []
+        self.coverage = 0.0
+
+    @property
+    def residual_text(self) -> str:
+        return "\n".join(self.residual_lines)
+
+    def to_stats(self, filename: str) -> Dict[str, Any]:
+        return {
+            "filename": filename,
+            "template_id": self.template_id,
+            "similarity": round(self.similarity, 3),
+            "line_coverage": round(self.coverage, 3),
+            "fields": len(self.partial_schema),
+            "residual_chars": len(self.residual_text),
+        }
+
+
+def apply_template(
+    template: Dict[str, Any], markdown: str, filename: str, similarity: float
+) -> TemplateMatch:
+    """Read references out of `markdown` with the template's line patterns."""
+    match = TemplateMatch(template["id"], similarity)
+    literal_lines = set(template["literal_lines"])
+    compiled = [
+        (re.compile(p["regex"]), re.compile(p["prev"]) if p["prev"] else None, p["fields"])
+        for p in template["patterns"]
+    ]
+    references: Dict[str, List[str]] = {}
+    matched = total = 0
+    prev_line = ""
+    for line in markdown.split("\n"):
+        if not line.strip():
+            continue
+        total += 1
+        explained = _line_hash(normalize_line(line)) in literal_lines
+        if not explained:
+            for regex, prev_regex, field_keys in compiled:
+                if prev_regex is not None and not prev_regex.fullmatch(prev_line):
+                    continue
+                m = regex.fullmatch(line)
+                if m is None:
+                    continue
+                values = [v.strip() for v in m.groups()]
+                if not all(values) or any(len(v) > MAX_REFERENCE_CHARS for v in values):
+                    continue
+                for field_key, value in zip(field_keys, values):
+                    references.setdefault(field_key, []).append(value)
+                explained = True
+                break
+        if explained:
+            matched += 1
+        else:
+            match.residual_lines.append(line)
+        prev_line = line
+
+    match.coverage = matched / total if total else 0.0
+    for field_key, refs in references.items():
+        field_meta = template["fields"].get(field_key, {})
+        match.partial_schema[field_key] = {
+            **field_meta,
+            "references": list(dict.fromkeys(refs)),
+            "source_filename": filename,
+        }
+    return match
+
+
+class TemplateStore:
+    """
+    Templates per scope (user + instructions + model + prompt version) in the
+    schema cache: one index entry with every template's signature, and one
+    entry per template body.
+    """
+
+    def __init__(
+        self,
+        cache: SchemaCache = schema_cache,
+        threshold: float = TEMPLATE_MATCH_THRESHOLD,
+        min_coverage: float = TEMPLATE_MIN_LINE_COVERAGE,
+        max_per_scope: int = TEMPLATE_MAX_PER_SCOPE,
+        ttl: int = TEMPLATE_TTL,
+    ):
+        self.cache = cache
+        self.threshold = threshold
+        self.min_coverage = min_coverage
+        self.max_per_scope = max_per_scope
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.counters = {"learned": 0, "matched": 0, "rejected": 0, "misses": 0}
+
+    @staticmethod
+    def _scope_key(scope: str) -> str:
+        return hashlib.sha256(scope.encode("utf-8")).hexdigest()
+
+    def _index_key(self, scope: str) -> str:
+        return f"{TEMPLATE_PREFIX}:index:{self._scope_key(scope)}"
+
+    def _template_key(self, scope: str, template_id: str) -> str:
+        return f"{TEMPLATE_PREFIX}:{self._scope_key(scope)}:{template_id}"
+
+    def learn(self, scope: str, markdown: str, partial_schema: Dict[str, Any]) -> Optional[str]:
+        """Store (or refresh) the template of an LLM-mapped document; returns its id."""
+        template = build_template(markdown, partial_schema)
+        if template is None:
+            return None
+        self.cache.set(self._template_key(scope, template["id"]), template, self.ttl)
+        # read-modify-write of the index is serialized per process; across
+        # processes the last writer wins, which at worst forgets a template
+        with self._lock:
+            index = self.cache.get(self._index_key(scope)) or {"templates": []}
+            entries = [e for e in index["templates"] if e["id"] != template["id"]]
+            entries.append(
+                {"id": template["id"], "signature": template["signature"], "shingles": template["shingles"]}
+            )
+            index["templates"] = entries[-self.max_per_scope:]
+            self.cache.set(self._index_key(scope), index, self.ttl)
+        self.counters["learned"] += 1
+        print(f"  🧩 TEMPLATE LEARNED: {template['id']} ({len(template['patterns'])} variable lines)")
+        return template["id"]
+
+    def match(self, scope: str, markdown: str, filename: str) -> Optional[TemplateMatch]:
+        """
+        Best template for `markdown` above the similarity threshold that also
+        explains enough of its lines, or None.
+        """
+        index = self.cache.get(self._index_key(scope))
+        if not index or not index.get("templates"):
+            self.counters["misses"] += 1
+            return None
+
+        entries = index["templates"]
+        signatures = np.array([e["signature"] for e in entries], dtype=np.uint64)
+        shingles = _shingles(markdown)
+        jaccard = (signatures == _signature_of(shingles)).mean(axis=1)
+        template_shingles = np.array([e.get("shingles") or 0 for e in entries], dtype=np.float64)
+        # templates stored before shingle counts were kept are scored by Jaccard
+        similarities = np.where(
+            template_shingles > 0,
+            estimate_containment(jaccard, template_shingles, len(shingles)),
+            jaccard,
+        )
+        for idx in np.argsort(-similarities):
+            similarity = float(similarities[idx])
+            if similarity < self.threshold:
+                break
+            template = self.cache.get(self._template_key(scope, entries[idx]["id"]))
+            if template is None:
+                continue
+            match = apply_template(template, markdown, filename, similarity)
+            if match.coverage >= self.min_coverage and match.partial_schema:
+                self.counters["matched"] += 1
+                return match
+            self.counters["rejected"] += 1
+
+        self.counters["misses"] += 1
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.counters)
+
+
+template_store = TemplateStore()
+
+
+if __name__ == "__main__":
+    from cache_service import LRUTTLCache, RedisCircuit
+
+    letter = """# Certificate of Participation
+
+This is to certify that **{name}** of {dept} has participated in the
+workshop on Machine Learning held on {date} at the Main Auditorium.
+The workshop covered supervised learning, model evaluation and deployment,
+with hands-on sessions conducted by the faculty of the department and invited
+speakers from industry. Participants completed all lab exercises and the
+final assessment to the satisfaction of the organizing committee.
+
+| Name | Roll No |
+|------|---------|
+| {name} | {roll} |
+
+Coordinator: Dr. {coord}
+"""
+    first = letter.format(name="Ramesh Kumar", dept="CSE", date="12 March 2024", roll="21CS045", coord="Anil Rao")
+    second = letter.format(name="Priya Nair", dept="ECE", date="3 April 2024", roll="21EC102", coord="Divya Iyer")
+    schema = {
+        "participant_name": {"label": "Participant Name", "references": ["Ramesh Kumar"]},
+        "department": {"label": "Department", "references": ["CSE"]},
+        "roll_number": {"label": "Roll Number", "references": ["21CS045"]},
+        "coordinator": {"label": "Coordinator", "references": ["Anil Rao"]},
+    }
+
+    store = TemplateStore(SchemaCache(RedisCircuit(url=None), LRUTTLCache()))
+    store.learn("demo", first, schema)
+    result = store.match("demo", second + "\nPrize: First Place in the hackathon track", "second.docx")
+    print(result.to_stats("second.docx"))
+    for key, val in result.partial_schema.items():
+        print(f"  {key}: {val['references']}")
+    print("residual:", repr(result.residual_text))
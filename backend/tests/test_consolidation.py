@@ -0,0 +1,66 @@
+"""
+Consolidation route of the schema discovery graph, with a stub LLM.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import copy
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schemaAgent  # noqa: E402
+
+
+class StubConsolidationLLM:
+    """Merges every field of a shard into the shard's first key."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def invoke(self, messages, config=None, **kwargs):
+        self.calls += 1
+        prompt = messages[0].content
+        start = prompt.index('{"fields"')
+        shard_fields = json.JSONDecoder().raw_decode(prompt[start:])[0]["fields"]
+        canon_key = next(iter(shard_fields))
+        references = [ref for refs in shard_fields.values() for ref in refs]
+        content = json.dumps({canon_key: {"label": "Student Name", "references": references}})
+        return SimpleNamespace(content=content, usage_metadata=None, response_metadata={})
+
+
+def make_state(llm):
+    fields = {
+        "student_name": {"label": "Student Name", "references": ["Ramesh Kumar"], "source_files": ["a.md"]},
+        "student_names": {"label": "Student Names", "references": ["Priya Nair"], "source_files": ["b.md"]},
+        "venue": {"label": "Venue", "references": ["Seminar Hall"], "source_files": ["a.md"]},
+    }
+    return {
+        "documents": [("a.md", ""), ("b.md", "")],
+        "partial_schemas": [{}, {}],
+        "final_schema": {"document_fields": {"fields": fields}},
+        "llm_instance": llm,
+        "llm_provider": "groq",
+        "llm_model": "stub",
+        "stats": copy.deepcopy(schemaAgent.INITIAL_STATS),
+    }
+
+
+def test_consolidate_route_merges_clustered_fields():
+    llm = StubConsolidationLLM()
+    state = make_state(llm)
+    state.update(schemaAgent.plan_consolidation(state))
+    assert schemaAgent.route_after_plan(state) == "consolidate_entities"
+
+    out = schemaAgent.consolidate_entities_llm(state)
+
+    fields = out["final_schema"]["document_fields"]["fields"]
+    assert llm.calls == 1
+    assert list(fields) == ["student_name", "venue"]
+    assert fields["student_name"]["references"] == ["Ramesh Kumar", "Priya Nair"]
+    assert fields["student_name"]["source_files"] == ["a.md", "b.md"]
+    assert fields["venue"]["references"] == ["Seminar Hall"]
+    assert out["stats"]["consolidation"]["shards"] == 1
@@ -0,0 +1,113 @@
+"""
+Multi-pattern text matching (Aho-Corasick).
+
+Builds one automaton over a set of literal patterns so a text can be scanned
+once for all of them, instead of calling ``str.find`` per pattern.
+"""
+import re
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+
+class MultiPatternMatcher:
+    """
+    Aho-Corasick automaton over literal (case-sensitive) patterns.
+
+    - iter_matches(text): every occurrence of every pattern, overlapping ones
+      included, as (start, pattern) tuples ordered by end position.
+    - find_non_overlapping(text): leftmost-longest, non-overlapping matches,
+      ordered by start position (what a replacement pass needs).
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        # Empty patterns would match everywhere; drop them and exact duplicates.
+        self.patterns: List[str] = list(dict.fromkeys(p for p in patterns if p))
+
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+
+        for pattern_id, pattern in enumerate(self.patterns):
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[state][ch] = nxt
+                state = nxt
+            self._out[state] = self._out[state] + (pattern_id,)
+
+        # BFS to wire failure links and merge outputs along them
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                if self._out[self._fail[nxt]]:
+                    self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+        # From the root, jump straight to the next char that can start a match
+        first_chars = "".join(sorted(self._goto[0].keys()))
+        self._first_char_re = (
+            re.compile("[" + re.escape(first_chars) + "]") if first_chars else None
+        )
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, str]]:
+        """Yield (start, pattern) for every (possibly overlapping) occurrence."""
+        if not text or self._first_char_re is None:
+            return
+
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self.patterns
+        lengths = [len(p) for p in patterns]
+        search_first = self._first_char_re.search
+        n = len(text)
+        state = 0
+        i = 0
+
+        while i < n:
+            if state == 0:
+                m = search_first(text, i)
+                if m is None:
+                    return
+                i = m.start()
+
+            ch = text[i]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+
+            if out[state]:
+                for pattern_id in out[state]:
+                    yield i - lengths[pattern_id] + 1, patterns[pattern_id]
+            i += 1
+
+    def find_non_overlapping(self, text: str) -> List[Tuple[int, int, str]]:
+        """
+        Leftmost-longest, non-overlapping matches as (start, end, pattern).
+        """
+        return select_non_overlapping(self.iter_matches(text))
+
+
+def select_non_overlapping(matches: Iterable[Tuple[int, str]]) -> List[Tuple[int, int, str]]:
+    """Leftmost-longest, non-overlapping (start, end, pattern) out of (start, pattern) matches."""
+    candidates = sorted((start, -len(pattern), pattern) for start, pattern in matches)
+    selected: List[Tuple[int, int, str]] = []
+    cursor = 0
+    for start, neg_len, pattern in candidates:
+        if start < cursor:
+            continue
+        end = start - neg_len
+        selected.append((start, end, pattern))
+        cursor = end
+    return selected